@@ -0,0 +1,542 @@
+"""Micro-benchmarks for the AHA poller.
+
+Run from the root of the package, e.g.
+
+    python benchmark.py normalize --entities 20000
+    python benchmark.py normalize --payload captured_entities_page.json
+    python benchmark.py poll --events 10 100 --accounts 1 100 --entities 2
+    python benchmark.py poll --fixture recorded_events.json --latency-ms 20
+    python benchmark.py coldstart --runs 10
+
+A captured payload is the JSON of a describe_affected_entities_for_organization
+page (as printed by the AWS CLI); its *Time fields are turned back into
+datetimes so the benchmark sees what boto3 returns.
+
+The poll benchmark runs describe_org_events (or describe_events with
+--no-org) against fake Health, Organizations and EventBridge clients and a fake
+webhook pool, with the state kept in an in-memory SQLite store. Each scenario
+runs in a forked process and is polled twice: the first poll alerts on every
+event, the second finds them all unchanged. A recorded fixture is a JSON object
+with "events", and "affectedAccounts", "affectedEntities" and
+"eventDescriptions" keyed by event arn.
+
+The coldstart benchmark times the import of handler in a fresh interpreter,
+then a first and a second invocation of main against the same fakes.
+"""
+import argparse
+import collections
+import contextlib
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType, SimpleNamespace
+
+import urllib3
+
+# handler picks its state backend when imported, the poll benchmark never touches AWS
+os.environ["STATE_BACKEND"] = "sqlite"
+for name, value in {
+    "DYNAMODB_TABLE": "aha-benchmark",
+    "EVENT_SEARCH_BACK": "1",
+    "HEALTH_EVENT_TYPE": "issue",
+    "REGIONS": "all regions",
+    "ACCOUNT_IDS": "None",
+    "FROM_EMAIL": "none@domain.com",
+    "TO_EMAIL": "none@domain.com",
+    "MANAGEMENT_ROLE_ARN": "None",
+    "ORG_STATUS": "Yes",
+}.items():
+    os.environ.setdefault(name, value)
+
+import handler  # noqa: E402
+
+
+def synthetic_entities_page(entity_count):
+    now = datetime.now(timezone.utc)
+    return {
+        "entities": [
+            {
+                "entityArn": f"arn:aws:health:us-east-1:123456789012:entity/g{i}",
+                "eventArn": "arn:aws:health:us-east-1::event/EC2/AWS_EC2_OPERATIONAL_ISSUE/x",
+                "entityValue": f"i-{i:017x}",
+                "awsAccountId": f"{100000000000 + i % 5000}",
+                "lastUpdatedTime": now,
+                "statusCode": "IMPAIRED",
+                "tags": {},
+            }
+            for i in range(entity_count)
+        ],
+        "failedSet": [],
+        "ResponseMetadata": {"HTTPStatusCode": 200, "RetryAttempts": 0},
+    }
+
+
+def load_captured_page(path):
+    def restore_datetimes(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key.endswith("Time") and isinstance(item, str):
+                    value[key] = datetime.fromisoformat(item)
+                else:
+                    restore_datetimes(item)
+        elif isinstance(value, list):
+            for item in value:
+                restore_datetimes(item)
+        return value
+
+    with open(path) as captured:
+        return restore_datetimes(json.load(captured))
+
+
+def json_round_trip(page):
+    return json.loads(json.dumps(page, default=handler.myconverter))
+
+
+# cpu time and peak traced allocations are taken in separate passes since
+# tracemalloc slows down the code it traces
+def measure(func, page, repeat):
+    pages = [copy.deepcopy(page) for _ in range(repeat)]
+    started = time.process_time()
+    for each_page in pages:
+        func(each_page)
+    cpu = time.process_time() - started
+
+    pages = [copy.deepcopy(page) for _ in range(repeat)]
+    tracemalloc.start()
+    for each_page in pages:
+        func(each_page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def bench_normalize(args):
+    page = load_captured_page(args.payload) if args.payload else synthetic_entities_page(args.entities)
+    # both strategies must produce the same result before their cost is compared
+    assert handler.normalize_datetimes(copy.deepcopy(page)) == json_round_trip(page)
+
+    print(f"{len(page['entities'])} entities x {args.repeat} pages")
+    results = {}
+    for name, func in (
+        ("json round-trip", json_round_trip),
+        ("normalize_datetimes", handler.normalize_datetimes),
+    ):
+        cpu, peak = measure(func, page, args.repeat)
+        results[name] = (cpu, peak)
+        print(f"  {name:20} cpu {cpu * 1000:9.1f} ms   peak alloc {peak / 1024:10.1f} KiB")
+    (old_cpu, old_peak), (new_cpu, new_peak) = results.values()
+    print(f"  speedup {old_cpu / max(new_cpu, 1e-9):.1f}x, allocations {old_peak / max(new_peak, 1):.1f}x lower")
+
+
+class SyntheticFixture:
+    def __init__(self, event_count, account_count, entity_count):
+        now = datetime.now(timezone.utc)
+        self.events = [
+            {
+                "arn": f"arn:aws:health:us-east-1::event/EC2/AWS_EC2_OPERATIONAL_ISSUE/bench{i}",
+                "service": "EC2",
+                "eventTypeCode": "AWS_EC2_OPERATIONAL_ISSUE",
+                "eventTypeCategory": "issue",
+                "region": "us-east-1",
+                "startTime": now - timedelta(minutes=30),
+                "lastUpdatedTime": now - timedelta(seconds=i),
+                "statusCode": "open",
+                "eventScopeCode": "ACCOUNT_SPECIFIC",
+            }
+            for i in range(event_count)
+        ]
+        self.account_ids = [f"{100000000000 + i}" for i in range(account_count)]
+        self.entity_count = entity_count
+
+    def affected_accounts(self, event_arn):
+        return self.account_ids
+
+    # entities are made on request so large scenarios only cost what the handler keeps
+    def affected_entities(self, event_arn, account_id):
+        return [
+            {
+                "entityArn": f"{event_arn}/entity/{account_id}/{i}",
+                "eventArn": event_arn,
+                "entityValue": f"i-{int(account_id) * 100 + i:017x}",
+                "awsAccountId": account_id,
+                "lastUpdatedTime": self.events[0]["lastUpdatedTime"],
+                "statusCode": "IMPAIRED",
+            }
+            for i in range(self.entity_count)
+        ]
+
+    def description(self, event_arn):
+        return f"Increased API error rates for {event_arn}"
+
+
+class RecordedFixture:
+    def __init__(self, path):
+        recorded = load_captured_page(path)
+        self.events = recorded["events"]
+        self.accounts = recorded.get("affectedAccounts", {})
+        self.entities = collections.defaultdict(list)
+        for event_arn, entities in recorded.get("affectedEntities", {}).items():
+            for entity in entities:
+                self.entities[(event_arn, entity.get("awsAccountId"))].append(entity)
+        self.descriptions = recorded.get("eventDescriptions", {})
+        self.account_ids = sorted({a for accounts in self.accounts.values() for a in accounts})
+
+    def affected_accounts(self, event_arn):
+        return self.accounts.get(event_arn, [])
+
+    def affected_entities(self, event_arn, account_id):
+        return self.entities.get((event_arn, account_id), [])
+
+    def description(self, event_arn):
+        return self.descriptions.get(event_arn, "")
+
+
+class FakeEventHooks:
+    def register(self, *args, **kwargs):
+        pass
+
+
+class FakeClient:
+    def __init__(self, service, latency):
+        self.service = service
+        self.latency = latency
+        self.meta = SimpleNamespace(events=FakeEventHooks())
+
+    # recorded like the handler records calls made through botocore
+    def call(self, operation):
+        started = time.monotonic()
+        time.sleep(self.latency)
+        handler.metrics.record_call(
+            self.service,
+            "".join(word.title() for word in operation.split("_")),
+            time.monotonic() - started,
+        )
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+
+class FakePaginator:
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        pages = getattr(self.client, "pages_" + self.operation)(**kwargs)
+        for page in pages:
+            self.client.call(self.operation)
+            yield page
+
+
+def chunks(items, size):
+    items = list(items)
+    return [items[i : i + size] for i in range(0, len(items), size)] or [[]]
+
+
+class FakeHealth(FakeClient):
+    def __init__(self, fixture, latency):
+        super().__init__("health", latency)
+        self.fixture = fixture
+
+    def pages_describe_events_for_organization(self, **kwargs):
+        for events in chunks(self.fixture.events, 100):
+            yield {"events": copy.deepcopy(events)}
+
+    pages_describe_events = pages_describe_events_for_organization
+
+    def pages_describe_affected_accounts_for_organization(self, eventArn):
+        for accounts in chunks(self.fixture.affected_accounts(eventArn), 100):
+            yield {"affectedAccounts": accounts, "eventScopeCode": "ACCOUNT_SPECIFIC"}
+
+    def pages_describe_affected_entities_for_organization(self, organizationEntityFilters):
+        entities = [
+            entity
+            for entity_filter in organizationEntityFilters
+            for entity in self.fixture.affected_entities(
+                entity_filter["eventArn"], entity_filter["awsAccountId"]
+            )
+        ]
+        for page in chunks(entities, 100):
+            yield {"entities": copy.deepcopy(page), "failedSet": []}
+
+    def pages_describe_affected_entities(self, filter):
+        account_ids = self.fixture.account_ids[:1]
+        entities = [
+            entity
+            for event_arn in filter["eventArns"]
+            for account_id in account_ids
+            for entity in self.fixture.affected_entities(event_arn, account_id)
+        ]
+        for page in chunks(entities, 100):
+            yield {"entities": copy.deepcopy(page)}
+
+    def event_details(self, event_arn):
+        event = next(event for event in self.fixture.events if event["arn"] == event_arn)
+        return {
+            "successfulSet": [
+                {
+                    "event": copy.deepcopy(event),
+                    "eventDescription": {"latestDescription": self.fixture.description(event_arn)},
+                }
+            ],
+            "failedSet": [],
+        }
+
+    def describe_event_details_for_organization(self, organizationEventDetailFilters):
+        self.call("describe_event_details_for_organization")
+        return self.event_details(organizationEventDetailFilters[0]["eventArn"])
+
+    def describe_event_details(self, eventArns):
+        self.call("describe_event_details")
+        return self.event_details(eventArns[0])
+
+
+class FakeOrganizations(FakeClient):
+    def __init__(self, fixture, latency):
+        super().__init__("organizations", latency)
+        self.fixture = fixture
+
+    def pages_list_accounts(self):
+        for account_ids in chunks(self.fixture.account_ids, 20):
+            yield {"Accounts": [{"Id": a, "Name": f"account-{a}"} for a in account_ids]}
+
+    def describe_account(self, AccountId):
+        self.call("describe_account")
+        return {"Account": {"Id": AccountId, "Name": f"account-{AccountId}"}}
+
+
+class FakeEvents(FakeClient):
+    def put_events(self, Entries):
+        self.call("put_events")
+        return {"FailedEntryCount": 0, "Entries": [{"EventId": "bench"} for _ in Entries]}
+
+
+# WebhookClient.post_json records the webhook calls itself
+class FakeWebhookPool:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def request(self, method, url, body, headers, **kwargs):
+        time.sleep(self.latency)
+        return urllib3.response.HTTPResponse(body=b"ok", status=200)
+
+
+class FakeAWSApi:
+    def __init__(self, clients):
+        self.clients = clients
+
+    def client(self, service, **kwargs):
+        return self.clients[service]
+
+
+def install_fakes(fixture, latency):
+    clients = {
+        "health": FakeHealth(fixture, latency),
+        "organizations": FakeOrganizations(fixture, latency),
+        "events": FakeEvents("events", latency),
+    }
+    # get_sts_token still runs, so the Health region is resolved as in Lambda
+    handler.aws_api = FakeAWSApi(clients)
+    handler.webhook_client.pool = FakeWebhookPool(latency)
+    handler.secrets_cache.snapshot = MappingProxyType(
+        {
+            "slack": "https://hooks.slack.com/services/benchmark",
+            "teams": "None",
+            "chime": "None",
+            "eventbusname": "aha-benchmark",
+            "ahaassumerole": "None",
+        }
+    )
+    handler.secrets_cache.fetched = float("inf")
+    # polls go through the region router as in main
+    return handler.HealthClientRouter()
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# log records are still formatted, as they would be in Lambda, but not shown
+def silence_logs():
+    devnull = open(os.devnull, "w")
+    for log_handler in handler.logger.handlers:
+        log_handler.setStream(devnull)
+    return devnull
+
+
+# one scenario, run in a fresh process so module state and peak RSS start clean
+def run_poll_scenario(scenario):
+    fixture = (
+        RecordedFixture(scenario["fixture"])
+        if scenario["fixture"]
+        else SyntheticFixture(scenario["events"], scenario["accounts"], scenario["entities"])
+    )
+    os.environ.update(scenario["environment"])
+    health_client = install_fakes(fixture, scenario["latency"])
+    describe = handler.describe_org_events if scenario["org"] else handler.describe_events
+    devnull = silence_logs()
+    polls = []
+    for poll in ("first", "repeat"):
+        handler.metrics.reset()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            describe(health_client)
+            handler.state_writer.flush()
+            handler.eventbridge_sink.flush()
+        polls.append(
+            {
+                "poll": poll,
+                "wall": time.perf_counter() - started,
+                "api_calls": {
+                    key: (calls, handler.metrics.latency[key])
+                    for key, calls in handler.metrics.calls.items()
+                },
+                "stages": dict(handler.metrics.stages),
+                "peak_rss": peak_rss_mib(),
+            }
+        )
+    return polls
+
+
+def print_poll_results(scenario, polls):
+    if scenario["fixture"]:
+        print(f"fixture {scenario['fixture']}")
+    else:
+        print(
+            f"{scenario['events']} events x {scenario['accounts']} accounts"
+            f" x {scenario['entities']} entities"
+        )
+    for result in polls:
+        print(
+            f"  {result['poll']:6} wall {result['wall'] * 1000:10.1f} ms"
+            f"   peak RSS {result['peak_rss']:8.1f} MiB"
+        )
+        services = collections.Counter()
+        for (service, operation), (count, latency) in sorted(result["api_calls"].items()):
+            services[service] += count
+            print(
+                f"           {service + ':' + operation:45} {count:8} calls"
+                f" {latency * 1000:10.1f} ms"
+            )
+        print("           calls per service: " + ", ".join(f"{s} {c}" for s, c in services.items()))
+        print("           stage times, summed over worker threads:")
+        for name, seconds in sorted(result["stages"].items(), key=lambda stage: -stage[1]):
+            print(f"           {name:45} {seconds * 1000:25.1f} ms")
+
+
+def bench_poll(args):
+    environment = {
+        "EVENT_WORKERS": str(args.event_workers),
+        "ENTITY_WORKERS": str(args.entity_workers),
+        "DDB_WRITE_MODE": args.write_mode,
+    }
+    if args.fixture:
+        grid = [(None, None)]
+    else:
+        grid = itertools.product(args.events, args.accounts)
+    fork = multiprocessing.get_context("fork")
+    for events, accounts in grid:
+        scenario = {
+            "fixture": args.fixture,
+            "events": events,
+            "accounts": accounts,
+            "entities": args.entities,
+            "org": args.org,
+            "latency": args.latency_ms / 1000,
+            "environment": environment,
+        }
+        with ProcessPoolExecutor(max_workers=1, mp_context=fork) as executor:
+            polls = executor.submit(run_poll_scenario, scenario).result()
+        print_poll_results(scenario, polls)
+
+
+# runs in a fresh interpreter so nothing is imported before handler
+COLD_START_CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import handler
+imported = time.perf_counter() - started
+import benchmark
+print(json.dumps(benchmark.first_invocations(imported, int(sys.argv[1]), int(sys.argv[2]))))
+"""
+
+
+def first_invocations(imported, event_count, account_count):
+    install_fakes(SyntheticFixture(event_count, account_count, 1), 0)
+    devnull = silence_logs()
+    result = {"import": imported}
+    for invocation in ("first", "warm"):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            handler.main({}, None)
+        result[invocation] = time.perf_counter() - started
+    result["peak_rss"] = peak_rss_mib()
+    return result
+
+
+def bench_coldstart(args):
+    runs = []
+    for _ in range(args.runs):
+        child = subprocess.run(
+            [sys.executable, "-c", COLD_START_CHILD, str(args.events), str(args.accounts)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        runs.append(json.loads(child.stdout.splitlines()[-1]))
+    print(f"{args.runs} cold starts, {args.events} events x {args.accounts} accounts")
+    for name in ("import", "first", "warm"):
+        timings = sorted(run[name] * 1000 for run in runs)
+        print(
+            f"  {name:8} median {statistics.median(timings):8.1f} ms"
+            f"   min {timings[0]:8.1f} ms   max {timings[-1]:8.1f} ms"
+        )
+    print(f"  peak RSS {max(run['peak_rss'] for run in runs):.1f} MiB")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    normalize = commands.add_parser("normalize", help="datetime normalization of Health responses")
+    normalize.add_argument("--entities", type=int, default=10000)
+    normalize.add_argument("--repeat", type=int, default=5)
+    normalize.add_argument("--payload", help="captured entities page (JSON)")
+    normalize.set_defaults(func=bench_normalize)
+
+    poll = commands.add_parser("poll", help="event polling against fake AWS clients")
+    poll.add_argument("--events", type=int, nargs="+", default=[10, 100, 1000])
+    poll.add_argument("--accounts", type=int, nargs="+", default=[1, 100, 5000])
+    poll.add_argument("--entities", type=int, default=1, help="entities per affected account")
+    poll.add_argument("--fixture", help="recorded Health data (JSON) instead of the grid")
+    poll.add_argument("--no-org", dest="org", action="store_false", help="describe_events")
+    poll.add_argument("--latency-ms", type=float, default=0, help="added to every fake call")
+    poll.add_argument("--event-workers", type=int, default=1)
+    poll.add_argument("--entity-workers", type=int, default=4)
+    poll.add_argument("--write-mode", choices=["conditional", "batch"], default="conditional")
+    poll.set_defaults(func=bench_poll)
+
+    coldstart = commands.add_parser("coldstart", help="handler import and first invocations")
+    coldstart.add_argument("--runs", type=int, default=5)
+    coldstart.add_argument("--events", type=int, default=10)
+    coldstart.add_argument("--accounts", type=int, default=10)
+    coldstart.set_defaults(func=bench_coldstart)
+
+    args = arg_parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,34 @@
+import collections
+import hashlib
 import json
 import logging
-from functools import lru_cache
+import random
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 
 import boto3
+import botocore.session
+import urllib3
 import os
+import pickle
 import socket
-from dateutil import parser
+import sys
+import threading
+import time
+import zlib
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from datetime import datetime, timedelta
-from urllib.request import Request, urlopen, URLError, HTTPError
 from botocore.config import Config
-from botocore.exceptions import ClientError
+from botocore.credentials import RefreshableCredentials
+from botocore.exceptions import (
+    BotoCoreError,
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
 from messagegenerator import (
     get_message_for_slack,
     get_org_message_for_slack,
@@ -25,62 +44,745 @@ from messagegenerator import (
 logger = logging.getLogger()
 logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
 
-class CachedSecrets:
-    def __init__(self, client):
-        self.client = client
+# attributes every LogRecord has, anything else was passed as a field through extra=
+LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "sample"}
+
+
+# one JSON object per record, fields passed through extra= are written next to the
+# message and cut to LOG_FIELD_LIMIT characters once serialized
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, field_limit):
+        super().__init__()
+        self.field_limit = field_limit
+
+    def format(self, record):
+        entry = {"level": record.levelname, "message": record.getMessage()}
+        for name, value in vars(record).items():
+            if name not in LOG_RECORD_ATTRIBUTES:
+                entry[name] = self.truncate(value)
+        if record.exc_info:
+            entry["exception"] = self.truncate(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+    def truncate(self, value):
+        if isinstance(value, (bool, int, float)) or value is None:
+            return value
+        text = value if isinstance(value, str) else json.dumps(value, default=str)
+        if len(text) <= self.field_limit:
+            return value
+        return f"{text[: self.field_limit]}... ({len(text) - self.field_limit} more characters)"
+
+
+# records logged with extra={"sample": True} repeat for every event, only the first
+# LOG_SAMPLE_FIRST of each message are written per invocation and then a
+# LOG_SAMPLE_RATE fraction of the rest
+class LogSampler(logging.Filter):
+    def __init__(self, first, rate):
+        super().__init__()
+        self.first = first
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.seen = collections.Counter()
+        self.suppressed = collections.Counter()
+
+    def filter(self, record):
+        if not getattr(record, "sample", False):
+            return True
+        with self.lock:
+            self.seen[record.msg] += 1
+            if self.seen[record.msg] <= self.first or random.random() < self.rate:
+                return True
+            self.suppressed[record.msg] += 1
+            return False
+
+    # counts of the suppressed records since the last reset
+    def reset(self):
+        with self.lock:
+            suppressed = dict(self.suppressed)
+            self.seen.clear()
+            self.suppressed.clear()
+        return suppressed
+
+
+# the Lambda runtime installs its own handler on the root logger, keep it and only swap
+# its format
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+for log_handler in logger.handlers:
+    log_handler.setFormatter(
+        StructuredFormatter(int(os.environ.get("LOG_FIELD_LIMIT", "1024")))
+    )
+log_sampler = LogSampler(
+    int(os.environ.get("LOG_SAMPLE_FIRST", "10")),
+    float(os.environ.get("LOG_SAMPLE_RATE", "0.01")),
+)
+logger.addFilter(log_sampler)
+# payload dumps at DEBUG shouldn't come with the SDK's wire logs
+for library in ("boto3", "botocore", "urllib3"):
+    logging.getLogger(library).setLevel(logging.WARNING)
+
+# clients are kept across warm invocations, role clients refresh their own credentials
+# through the role session. boto3's default session isn't thread-safe, so clients are
+# looked up and created one at a time. The lock is re-entrant because creating a role
+# client assumes the role with the sts client
+class AWSApi:
+    def __init__(self):
+        self.lock = threading.RLock()
 
-    @lru_cache
-    def get_secret_value(self, *args, **kwargs):
-        logger.debug(f"Getting secret {kwargs}")
-        return self.client.get_secret_value(*args, **kwargs)
+    def client(self, *args, **kwargs):
+        with self.lock:
+            return self.new_client(*args, **kwargs)
+
+    def resource(self, resource_name):
+        with self.lock:
+            return self.new_resource(resource_name)
 
+    def role_client(self, role_arn, *args, **kwargs):
+        with self.lock:
+            return self.new_role_client(role_arn, *args, **kwargs)
 
-class AWSApi:
     @lru_cache
-    def client(self, *args, **kwargs):
+    def new_client(self, *args, **kwargs):
         logger.debug(f"Returning new boto3 client for: {args}")
-        return boto3.client(*args, **kwargs)
+        return metrics.instrument(boto3.client(*args, **kwargs))
 
     @lru_cache
-    def resource(self, resource_name):
+    def new_resource(self, resource_name):
         logger.debug(f"Returning new boto3 resource for: {resource_name}")
-        return boto3.resource(resource_name)
+        resource = boto3.resource(resource_name)
+        metrics.instrument(resource.meta.client)
+        return resource
+
+    @lru_cache
+    def new_role_client(self, role_arn, *args, **kwargs):
+        logger.debug(f"Returning new boto3 client for: {args} as {role_arn}")
+        return metrics.instrument(get_role_session(role_arn).client(*args, **kwargs))
 
     def cache_clear(self):
-        self.client.cache_clear()
-        self.resource.cache_clear()
+        with self.lock:
+            self.new_client.cache_clear()
+            self.new_resource.cache_clear()
+            self.new_role_client.cache_clear()
+
+
+# error codes counted as throttling, webhooks report their HTTP status
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "ProvisionedThroughputExceededException",
+    "429",
+}
+
+
+# per-invocation stage durations and API calls by service and operation, reported once the
+# invocation ends as a CloudWatch Embedded Metric Format line and a summary. A stage's
+# duration excludes the stages nested in it, durations are summed over worker threads
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.stages = collections.Counter()
+            self.calls = collections.Counter()
+            self.latency = collections.Counter()
+            self.retries = collections.Counter()
+            self.errors = collections.Counter()
+            self.throttles = collections.Counter()
+            self.counts = collections.Counter()
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.stages[name] += elapsed - nested
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    # time spent fetching each item of a lazy iterable, e.g. the pages of a paginator
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def record_call(self, service, operation, seconds, retries=0, error_code=None):
+        key = (service, operation)
+        with self.lock:
+            self.calls[key] += 1
+            self.latency[key] += seconds
+            self.retries[key] += retries
+            if error_code is not None:
+                self.errors[key] += 1
+            if error_code in THROTTLING_ERROR_CODES:
+                self.throttles[key] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    # time the current thread spent waiting inside a call rather than on the wire
+    def pause(self, seconds):
+        self.local.paused = self.local.__dict__.get("paused", 0.0) + seconds
+
+    # the call is timed after the other before-call handlers, and the time its attempts
+    # waited for Health pacing is taken out, so pacing isn't counted as latency
+    def instrument(self, client):
+        client.meta.events.register_last(
+            "before-call", self.before_call, unique_id="aha-metrics-before-call"
+        )
+        client.meta.events.register(
+            "after-call", self.after_call, unique_id="aha-metrics-after-call"
+        )
+        return client
+
+    def before_call(self, context, **kwargs):
+        context["aha_call_started"] = time.monotonic()
+        context["aha_call_paused"] = self.local.__dict__.get("paused", 0.0)
+
+    def after_call(self, parsed, model, context, **kwargs):
+        paused = self.local.__dict__.get("paused", 0.0) - context.get("aha_call_paused", 0.0)
+        self.record_call(
+            model.service_model.service_name,
+            model.name,
+            time.monotonic() - context.get("aha_call_started", time.monotonic()) - paused,
+            parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            parsed.get("Error", {}).get("Code"),
+        )
 
-    @lru_cache
-    def secretsmanager(self, **kwargs):
-        client = boto3.client("secretsmanager", **kwargs)
-        return CachedSecrets(client)
-
-
-print("boto3 version: ", boto3.__version__)
-
-# query active health API endpoint
-health_dns = socket.gethostbyname_ex("global.health.amazonaws.com")
-(current_endpoint, global_endpoint, ip_endpoint) = health_dns
-health_active_list = current_endpoint.split(".")
-health_active_region = health_active_list[1]
-print("current health region: ", health_active_region)
-
-# create a boto3 health client w/ backoff/retry
-config = Config(
-    region_name=health_active_region,
-    retries=dict(
-        max_attempts=10  # org view apis have a lower tps than the single
-        # account apis so we need to use larger
-        # backoff/retry values than than the boto defaults
-    ),
+    def summary(self):
+        lines = [f"Invocation took {(time.monotonic() - self.started) * 1000:.0f} ms"]
+        for name, seconds in self.stages.most_common():
+            lines.append(f"  stage {name}: {seconds * 1000:.0f} ms")
+        for (service, operation), calls in sorted(self.calls.items()):
+            key = (service, operation)
+            lines.append(
+                f"  {service} {operation}: {calls} calls, {self.latency[key] * 1000:.0f} ms,"
+                f" {self.retries[key]} retries, {self.errors[key]} errors,"
+                f" {self.throttles[key]} throttled"
+            )
+        for name, value in sorted(self.counts.items()):
+            lines.append(f"  {name}: {value}")
+        return lines
+
+    # EMF documents are limited to 100 metrics, larger sets are split over several lines
+    def emf_documents(self):
+        metrics = {"Duration": ((time.monotonic() - self.started) * 1000, "Milliseconds")}
+        for name, seconds in self.stages.items():
+            metrics[f"Stage.{name}"] = (seconds * 1000, "Milliseconds")
+        for (service, operation), calls in self.calls.items():
+            key = (service, operation)
+            prefix = f"{service}.{operation}"
+            metrics[f"{prefix}.Calls"] = (calls, "Count")
+            metrics[f"{prefix}.Latency"] = (self.latency[key] * 1000, "Milliseconds")
+            metrics[f"{prefix}.Retries"] = (self.retries[key], "Count")
+            metrics[f"{prefix}.Errors"] = (self.errors[key], "Count")
+            metrics[f"{prefix}.Throttles"] = (self.throttles[key], "Count")
+        for name, value in self.counts.items():
+            metrics[name] = (value, "Count")
+        names = list(metrics)
+        for i in range(0, len(names), 100):
+            document = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": os.environ.get("METRICS_NAMESPACE", "AHA"),
+                            "Dimensions": [["FunctionName"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": metrics[name][1]}
+                                for name in names[i : i + 100]
+                            ],
+                        }
+                    ],
+                },
+                "FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "aha"),
+            }
+            document.update({name: metrics[name][0] for name in names[i : i + 100]})
+            yield document
+
+    # EMF documents have to be written as bare JSON lines, not as log records
+    def emit(self):
+        with self.lock:
+            if os.environ.get("EMF_METRICS", "True") == "True":
+                for document in self.emf_documents():
+                    print(json.dumps(document))
+            logger.info("\n".join(self.summary()))
+
+
+metrics = Metrics()
+
+
+# the active Health API region, read from the CNAME of the global endpoint on first use
+# rather than at import and again once HEALTH_REGION_TTL seconds have passed. When the
+# lookup fails the last known region, or the first of HEALTH_REGIONS, is used. A region
+# that failed over is avoided for HEALTH_FAILOVER_COOLDOWN seconds, even if the CNAME
+# still points to it
+class HealthRegion:
+    def __init__(self, ttl, regions, cooldown):
+        self.ttl = ttl
+        self.regions = regions
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.region = None
+        self.resolved = 0
+        self.failed_until = {}
+
+    def get(self):
+        with self.lock:
+            if self.region is None or time.monotonic() - self.resolved >= self.ttl:
+                resolved_region = self.resolve()
+                self.region = self.choose(resolved_region) or resolved_region
+                self.resolved = time.monotonic()
+            return self.region
+
+    # move off a region that failed, returns the region to retry in or None when there is
+    # no healthy region left to try
+    def fail_over(self, failed_region):
+        with self.lock:
+            self.failed_until[failed_region] = time.monotonic() + self.cooldown
+            region = self.choose(self.resolve())
+            if region is None:
+                return None
+            self.region = region
+            self.resolved = time.monotonic()
+            logger.warning("Failing over Health calls from %s to %s", failed_region, region)
+            return region
+
+    # the resolved region unless it is cooling down, then the first healthy one
+    def choose(self, resolved_region):
+        now = time.monotonic()
+        for region in [resolved_region] + self.regions:
+            if self.failed_until.get(region, 0) <= now:
+                return region
+        return None
+
+    def resolve(self):
+        try:
+            current_endpoint, _, _ = socket.gethostbyname_ex("global.health.amazonaws.com")
+        except OSError as e:
+            region = self.region or self.regions[0]
+            logger.warning(
+                "Unable to resolve the active Health region, using %s",
+                region,
+                extra={"error": str(e)},
+            )
+            return region
+        region = current_endpoint.split(".")[1]
+        logger.info("current health region: %s", region)
+        return region
+
+
+health_region = HealthRegion(
+    int(os.environ.get("HEALTH_REGION_TTL", "300")),
+    [
+        region.strip()
+        for region in os.environ.get("HEALTH_REGIONS", "us-east-1,us-east-2").split(",")
+    ],
+    int(os.environ.get("HEALTH_FAILOVER_COOLDOWN", "300")),
 )
 
+
+# errors after which Health calls are retried in the other region, throttling errors only
+# get here once the client's own retries are used up
+HEALTH_FAILOVER_ERRORS = (
+    EndpointConnectionError,
+    ConnectTimeoutError,
+    ConnectionClosedError,
+    ReadTimeoutError,
+)
+
+
+def is_health_failover_error(error):
+    if isinstance(error, ClientError):
+        return error.response["Error"]["Code"] in THROTTLING_ERROR_CODES
+    return isinstance(error, HEALTH_FAILOVER_ERRORS)
+
+
+# stands in for the Health client, sending each call to the client of the active region
+# and retrying it in the other region when it fails with a failover error
+class HealthClientRouter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def client(self, region):
+        with self.lock:
+            if region not in self.clients:
+                health_client = get_sts_token("health", region)
+                register_health_throttle(health_client)
+                self.clients[region] = health_client
+            return self.clients[region]
+
+    def call(self, operation_name, **kwargs):
+        region = health_region.get()
+        while True:
+            try:
+                return getattr(self.client(region), operation_name)(**kwargs)
+            except Exception as e:
+                region = self.next_region(region, e)
+
+    def next_region(self, region, error):
+        if not is_health_failover_error(error):
+            raise error
+        next_region = health_region.fail_over(region)
+        if next_region is None:
+            raise error
+        logger.warning(
+            "Health call failed in %s, retrying in %s",
+            region,
+            next_region,
+            extra={"error": str(error)},
+        )
+        return next_region
+
+    def describe_event_details(self, **kwargs):
+        return self.call("describe_event_details", **kwargs)
+
+    def describe_event_details_for_organization(self, **kwargs):
+        return self.call("describe_event_details_for_organization", **kwargs)
+
+    def get_paginator(self, operation_name):
+        return HealthPaginator(self, operation_name)
+
+
+# pagination tokens don't carry over between regions, a listing that fails over is
+# started again in the other region and the pages already returned are skipped
+class HealthPaginator:
+    def __init__(self, router, operation_name):
+        self.router = router
+        self.operation_name = operation_name
+
+    def paginate(self, **kwargs):
+        region = health_region.get()
+        returned = 0
+        while True:
+            paginator = self.router.client(region).get_paginator(self.operation_name)
+            try:
+                for number, page in enumerate(paginator.paginate(**kwargs)):
+                    if number >= returned:
+                        returned += 1
+                        yield page
+                return
+            except Exception as e:
+                region = self.router.next_region(region, e)
+
+
+# create a boto3 client config w/ backoff/retry, one per region so the clients cached by
+# AWSApi are reused. Connections time out after CONNECT_TIMEOUT seconds rather than
+# botocore's 60 so an unreachable Health endpoint fails over quickly
+@lru_cache
+def get_client_config(region_name):
+    return Config(
+        region_name=region_name,
+        connect_timeout=int(os.environ.get("CONNECT_TIMEOUT", "10")),
+        retries=dict(
+            max_attempts=10  # org view apis have a lower tps than the single
+            # account apis so we need to use larger
+            # backoff/retry values than than the boto defaults
+        ),
+    )
+
+
 aws_api = AWSApi()
 
 
-# TODO decide if account_name should be blank on error
+# boto3 sessions keyed by role arn, kept across warm invocations. The assumed role
+# session lasts 900 seconds, so it is refreshed shortly before it expires rather than
+# on every use as botocore's default 15/10 minute margins would
+role_sessions = {}
+role_sessions_lock = threading.Lock()
+
+
+def get_role_session(role_arn):
+    with role_sessions_lock:
+        if role_arn not in role_sessions:
+            botocore_session = botocore.session.get_session()
+            botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+                metadata=assume_role(role_arn),
+                refresh_using=lambda: assume_role(role_arn),
+                method="sts-assume-role",
+                advisory_timeout=120,
+                mandatory_timeout=60,
+            )
+            role_sessions[role_arn] = boto3.Session(botocore_session=botocore_session)
+        return role_sessions[role_arn]
+
+
+def assume_role(role_arn):
+    logger.info("Assuming role", extra={"role_arn": role_arn})
+    sts_connection = aws_api.client("sts")
+    credentials = sts_connection.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName="cross_acct_aha_session",
+        DurationSeconds=900,
+    )["Credentials"]
+    return {
+        "access_key": credentials["AccessKeyId"],
+        "secret_key": credentials["SecretAccessKey"],
+        "token": credentials["SessionToken"],
+        "expiry_time": credentials["Expiration"].isoformat(),
+    }
+
+# BatchGetItem reads up to 100 keys per call
+DDB_BATCH_GET_LIMIT = 100
+
+# sentinel item in the dynamoDB table holding the last successful poll time
+POLL_WATERMARK_ARN = "aha:poll-watermark"
+# sentinel item in the dynamoDB table holding the account directory snapshot
+ACCOUNT_DIRECTORY_ARN = "aha:account-directory"
+
+
+# token bucket for one Health operation, shared by every worker thread. The rate is
+# halved when a call is throttled (at most once a second, so one burst of throttles
+# counts once) and grows back by `increase` TPS for every second of calls that aren't,
+# staying between min_rate and max_rate. A rate of 0 turns pacing off
+class AdaptiveRateLimiter:
+    def __init__(self, rate, min_rate, max_rate, increase, burst):
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.max_rate = max(max_rate, rate)
+        self.increase = increase
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.decreased = 0.0
+
+    # calls that find the bucket empty reserve the next token and wait for it, so waiting
+    # threads are let through in order at the current rate. Returns the seconds waited
+    def acquire(self):
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def on_throttle(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.decreased < 1.0:
+                return
+            self.decreased = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            rate = self.rate
+        logger.info("Health calls throttled, slowing down to %.1f TPS", rate, extra={"sample": True})
+
+    def on_success(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+
+# operation name -> limiter. The org view apis have a lower tps than the single account
+# apis, so they start at HEALTH_ORG_TPS rather than HEALTH_TPS
+health_rate_limiters = {}
+health_rate_limiters_lock = threading.Lock()
+
+
+def get_health_rate_limiter(operation_name):
+    with health_rate_limiters_lock:
+        if operation_name not in health_rate_limiters:
+            if operation_name.endswith("ForOrganization"):
+                rate = float(os.environ.get("HEALTH_ORG_TPS", "10"))
+            else:
+                rate = float(os.environ.get("HEALTH_TPS", "20"))
+            health_rate_limiters[operation_name] = AdaptiveRateLimiter(
+                rate,
+                float(os.environ.get("HEALTH_MIN_TPS", "0.5")),
+                float(os.environ.get("HEALTH_MAX_TPS", "50")),
+                float(os.environ.get("HEALTH_TPS_INCREASE", "1")),
+                float(os.environ.get("HEALTH_BURST", "1")),
+            )
+        return health_rate_limiters[operation_name]
+
+
+# before-send is emitted for every attempt, including the ones botocore retries itself,
+# so retries of a throttled call are paced too. before-call only runs once per call
+def throttle_health_call(event_name, **kwargs):
+    operation_name = event_name.rsplit(".", 1)[-1]
+    metrics.pause(get_health_rate_limiter(operation_name).acquire())
+
+
+# every attempt goes through needs-retry, including the ones botocore retries itself
+def adapt_health_rate(response, operation, **kwargs):
+    if response is not None:
+        if response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            get_health_rate_limiter(operation.name).on_throttle()
+
+
+def record_health_success(parsed, model, **kwargs):
+    if "Error" not in parsed:
+        get_health_rate_limiter(model.name).on_success()
+
+
+def register_health_throttle(health_client):
+    events = health_client.meta.events
+    events.register(
+        "before-send.health", throttle_health_call, unique_id="aha-health-throttle"
+    )
+    events.register(
+        "needs-retry.health", adapt_health_rate, unique_id="aha-health-throttle-retry"
+    )
+    events.register(
+        "after-call.health", record_health_success, unique_id="aha-health-throttle-success"
+    )
+
+
+# run func over items on a bounded worker pool, results are yielded lazily in input order.
+# Items are submitted in a window of max_workers, so no more than that many results are
+# held ahead of the consumer
+def map_bounded(func, items, max_workers):
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def map_events(func, items):
+    return map_bounded(func, items, int(os.environ.get("EVENT_WORKERS", "1")))
+
+
+# the organization entity api accepts up to 10 account/event filters per call
+ORG_ENTITY_FILTER_LIMIT = 10
+
+
+# account id -> name directory built from a single organizations:ListAccounts sweep and kept
+# across warm invocations, optionally snapshotted to dynamoDB so cold starts can skip the sweep
+class AccountDirectory:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.names = {}
+        self.fetched = 0
+
+    def get_name(self, account_id):
+        with self.lock:
+            if int(time.time()) - self.fetched >= self.ttl:
+                self.refresh()
+            account_name = self.names.get(account_id)
+        if account_name is None:
+            # account joined the organization after the last sweep
+            account_name = describe_account_name(account_id)
+            with self.lock:
+                self.names[account_id] = account_name
+        return account_name
+
+    def refresh(self):
+        now = int(time.time())
+        if self.load_snapshot(now):
+            return
+        try:
+            org_client = get_sts_token("organizations")
+            names = {}
+            for page in org_client.get_paginator("list_accounts").paginate():
+                for account in page["Accounts"]:
+                    names[account["Id"]] = account["Name"]
+        except Exception as e:
+            logger.warning(
+                "Unable to list organization accounts, falling back to DescribeAccount",
+                extra={"error": str(e)},
+            )
+            names = {}
+        else:
+            logger.info("Loaded %d accounts into the account directory", len(names))
+            self.save_snapshot(names, now)
+        self.names = names
+        self.fetched = now
+
+    def load_snapshot(self, now):
+        if os.environ.get("ACCOUNT_DIRECTORY_SNAPSHOT", "False") != "True":
+            return False
+        try:
+            item = state_store.get_item(ACCOUNT_DIRECTORY_ARN)
+        except ClientError as e:
+            logger.warning(
+                "Unable to read the account directory snapshot",
+                extra={"error": e.response["Error"]["Message"]},
+            )
+            return False
+        if item is None or now - int(item["fetched"]) >= self.ttl:
+            return False
+        # dynamoDB returns binary attributes wrapped in a Binary
+        accounts = getattr(item["accounts"], "value", item["accounts"])
+        self.names = json.loads(zlib.decompress(accounts))
+        self.fetched = int(item["fetched"])
+        return True
+
+    def save_snapshot(self, names, now):
+        if os.environ.get("ACCOUNT_DIRECTORY_SNAPSHOT", "False") != "True":
+            return
+        try:
+            state_store.put_item(
+                {
+                    "arn": ACCOUNT_DIRECTORY_ARN,
+                    "fetched": now,
+                    "accounts": zlib.compress(json.dumps(names).encode("utf-8")),
+                }
+            )
+        except ClientError as e:
+            logger.warning(
+                "Unable to save the account directory snapshot",
+                extra={"error": e.response["Error"]["Message"]},
+            )
+
+
+account_directory = AccountDirectory(int(os.environ.get("ACCOUNT_DIRECTORY_TTL", "3600")))
+
+
 # Get Account Name
+@metrics.timed("AccountNames")
 def get_account_name(account_id):
+    return account_directory.get_name(account_id)
+
+
+# TODO decide if account_name should be blank on error
+def describe_account_name(account_id):
     org_client = get_sts_token("organizations")
     try:
         account_name = org_client.describe_account(AccountId=account_id)["Account"][
@@ -92,237 +794,331 @@ def get_account_name(account_id):
 
 
 def send_alert(event_details, affected_accounts, affected_entities, event_type):
-    slack_url = get_secrets()["slack"]
-    teams_url = get_secrets()["teams"]
-    chime_url = get_secrets()["chime"]
-    SENDER = os.environ["FROM_EMAIL"]
-    RECIPIENT = os.environ["TO_EMAIL"]
-    event_bus_name = get_secrets()["eventbusname"]
-
     # get the list of resources from the array of affected entities
     resources = get_resources_from_entities(affected_entities)
 
-    if "None" not in event_bus_name:
-        try:
-            print("Sending the alert to Event Bridge")
-            send_to_eventbridge(
-                get_detail_for_eventbridge(event_details, affected_entities),
-                event_type,
-                resources,
-                event_bus_name,
-            )
-        except HTTPError as e:
-            print(
-                "Got an error while sending message to EventBridge: ", e.code, e.reason
-            )
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
-    #Slack Notification Handling
-    if slack_url != "None":
-        for slack_webhook_type in ["services", "triggers", "workflows"]:
-            if ("hooks.slack.com/" + slack_webhook_type) in slack_url:
-                print("Sending the alert to Slack Webhook Channel")
-                try:
-                    send_to_slack(
-                        get_message_for_slack(
-                            event_details,
-                            event_type,
-                            affected_accounts,
-                            resources,
-                            slack_webhook_type,
-                        ),
-                        slack_url,
-                    )
-                    break
-                except HTTPError as e:
-                    print("Got an error while sending message to Slack: ", e.code, e.reason)
-                except URLError as e:
-                    print("Server connection failed: ", e.reason)
-                    pass
-        else:
-            print("Unsupported format in Slack Webhook")
-
-    if "office.com/webhook" in teams_url:
-        try:
-            print("Sending the alert to Teams")
-            send_to_teams(
-                get_message_for_teams(
-                    event_details, event_type, affected_accounts, resources
-                ),
-                teams_url,
-            )
-        except HTTPError as e:
-            print("Got an error while sending message to Teams: ", e.code, e.reason)
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
-    # validate sender and recipient's email addresses
-    if "none@domain.com" not in SENDER and RECIPIENT:
-        try:
-            print("Sending the alert to the emails")
-            send_email(event_details, event_type, affected_accounts, resources)
-        except HTTPError as e:
-            print("Got an error while sending message to Email: ", e.code, e.reason)
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
-    if "hooks.chime.aws/incomingwebhooks" in chime_url:
-        try:
-            print("Sending the alert to Chime channel")
-            send_to_chime(
-                get_message_for_chime(
-                    event_details, event_type, affected_accounts, resources
-                ),
-                chime_url,
-            )
-        except HTTPError as e:
-            print("Got an error while sending message to Chime: ", e.code, e.reason)
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
+    return dispatch_alert(
+        get_alert_channels(
+            event_details,
+            affected_accounts,
+            affected_entities,
+            resources,
+            event_type,
+            is_org_mode=False,
+        )
+    )
 
 
 def send_org_alert(
     event_details, affected_org_accounts, affected_org_entities, event_type
 ):
-    slack_url = get_secrets()["slack"]
-    teams_url = get_secrets()["teams"]
-    chime_url = get_secrets()["chime"]
-    SENDER = os.environ["FROM_EMAIL"]
-    RECIPIENT = os.environ["TO_EMAIL"]
-    event_bus_name = get_secrets()["eventbusname"]
-
     # get the list of resources from the array of affected entities
     resources = get_resources_from_entities(affected_org_entities)
 
-    if "None" not in event_bus_name:
-        try:
-            print("Sending the org alert to Event Bridge")
-            send_to_eventbridge(
-                get_detail_for_eventbridge(event_details, affected_org_entities),
-                event_type,
-                resources,
-                event_bus_name,
+    return dispatch_alert(
+        get_alert_channels(
+            event_details,
+            affected_org_accounts,
+            affected_org_entities,
+            resources,
+            event_type,
+            is_org_mode=True,
+        )
+    )
+
+
+class WebhookError(Exception):
+    pass
+
+
+# http transport shared by the chat webhook senders, connections to each host are kept
+# alive across warm invocations and 429/5xx responses are retried honoring Retry-After.
+# No retry is made when Retry-After is longer than WEBHOOK_MAX_BACKOFF. With a deadline,
+# each attempt's timeouts are cut to the time left and no retry is made once the backoff
+# would leave less than the connect timeout to make it in
+class WebhookClient:
+    def __init__(self):
+        self.max_attempts = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "3"))
+        self.max_backoff = float(os.environ.get("WEBHOOK_MAX_BACKOFF", "8"))
+        self.connect_timeout = float(os.environ.get("WEBHOOK_CONNECT_TIMEOUT", "3"))
+        self.read_timeout = float(os.environ.get("WEBHOOK_READ_TIMEOUT", "10"))
+        self.pool = urllib3.PoolManager(
+            num_pools=10,
+            maxsize=4,
+            timeout=urllib3.Timeout(connect=self.connect_timeout, read=self.read_timeout),
+            retries=False,
+        )
+
+    def post_json(self, url, payload, headers, deadline=None):
+        body = json.dumps(payload).encode("utf-8")
+        for attempt in range(1, self.max_attempts + 1):
+            started = time.monotonic()
+            # an explicit timeout=None would disable the pool's timeouts
+            options = {} if deadline is None else {"timeout": self.timeout(deadline)}
+            try:
+                response = self.pool.request(
+                    "POST", url, body=body, headers=headers, **options
+                )
+            except urllib3.exceptions.HTTPError as e:
+                metrics.record_call(
+                    "webhook", "POST", time.monotonic() - started, error_code=type(e).__name__
+                )
+                delay = self.backoff(attempt)
+                if attempt == self.max_attempts or not self.can_retry(deadline, delay):
+                    raise
+                logger.warning("Webhook request failed, retrying", extra={"error": str(e)})
+                time.sleep(delay)
+                continue
+            metrics.record_call(
+                "webhook",
+                "POST",
+                time.monotonic() - started,
+                error_code=str(response.status) if response.status >= 400 else None,
             )
-        except HTTPError as e:
-            print(
-                "Got an error while sending message to EventBridge: ", e.code, e.reason
+            if response.status < 400:
+                return response
+            delay = self.backoff(attempt, response.headers.get("Retry-After"))
+            if (
+                (response.status != 429 and response.status < 500)
+                or attempt == self.max_attempts
+                or delay is None
+                or not self.can_retry(deadline, delay)
+            ):
+                raise WebhookError(
+                    f"{response.status} {response.reason}: {response.data[:200]!r}"
+                )
+            logger.warning("Webhook returned %d, retrying in %.1fs", response.status, delay)
+            time.sleep(delay)
+
+    def timeout(self, deadline):
+        remaining = max(0.1, deadline - time.monotonic())
+        return urllib3.Timeout(
+            connect=min(self.connect_timeout, remaining),
+            read=min(self.read_timeout, remaining),
+        )
+
+    def can_retry(self, deadline, delay):
+        return deadline is None or deadline - time.monotonic() - delay >= self.connect_timeout
+
+    # full jitter exponential backoff added to the server's Retry-After, or None when
+    # Retry-After is longer than max_backoff and the request shouldn't be retried
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_backoff, 0.5 * 2**attempt))
+        if retry_after is not None:
+            try:
+                retry_after = max(0.0, float(retry_after))
+            except ValueError:
+                return delay  # HTTP-date Retry-After values fall back to plain backoff
+            if retry_after > self.max_backoff:
+                return None
+            delay += retry_after
+        return delay
+
+
+webhook_client = WebhookClient()
+
+
+# the configured notification channels as (name, send function) pairs, each send
+# function takes the time.monotonic() deadline its channel has to finish by
+def get_alert_channels(
+    event_details, affected_accounts, affected_entities, resources, event_type, is_org_mode
+):
+    secrets = get_secrets()
+    slack_url = secrets["slack"]
+    teams_url = secrets["teams"]
+    chime_url = secrets["chime"]
+    SENDER = os.environ["FROM_EMAIL"]
+    RECIPIENT = os.environ["TO_EMAIL"]
+    event_bus_name = secrets["eventbusname"]
+    channels = []
+
+    if "None" not in event_bus_name:
+        channels.append(
+            (
+                "EventBridge",
+                lambda deadline: send_to_eventbridge(
+                    get_detail_for_eventbridge(event_details, affected_entities),
+                    event_type,
+                    resources,
+                    event_bus_name,
+                ),
             )
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
-    #Slack Notification Handling
+        )
+    # Slack Notification Handling
     if slack_url != "None":
         for slack_webhook_type in ["services", "triggers", "workflows"]:
             if ("hooks.slack.com/" + slack_webhook_type) in slack_url:
-                print("Sending the alert to Slack Webhook Channel")
-                try:
-                    send_to_slack(
-                        get_message_for_slack(
-                            event_details,
-                            event_type,
-                            affected_org_accounts,
-                            resources,
-                            slack_webhook_type,
+                channels.append(
+                    (
+                        "Slack",
+                        lambda deadline: send_to_slack(
+                            get_message_for_slack(
+                                event_details,
+                                event_type,
+                                affected_accounts,
+                                resources,
+                                slack_webhook_type,
+                            ),
+                            slack_url,
+                            deadline,
                         ),
-                        slack_url,
                     )
-                    break
-                except HTTPError as e:
-                    print("Got an error while sending message to Slack: ", e.code, e.reason)
-                except URLError as e:
-                    print("Server connection failed: ", e.reason)
-                    pass
+                )
+                break
         else:
-            print("Unsupported format in Slack Webhook")
+            logger.error("Unsupported format in Slack Webhook")
 
     if "office.com/webhook" in teams_url:
-        try:
-            print("Sending the alert to Teams")
-            send_to_teams(
-                get_org_message_for_teams(
-                    event_details, event_type, affected_org_accounts, resources
+        get_teams_message = (
+            get_org_message_for_teams if is_org_mode else get_message_for_teams
+        )
+        channels.append(
+            (
+                "Teams",
+                lambda deadline: send_to_teams(
+                    get_teams_message(
+                        event_details, event_type, affected_accounts, resources
+                    ),
+                    teams_url,
+                    deadline,
                 ),
-                teams_url,
             )
-        except HTTPError as e:
-            print("Got an error while sending message to Teams: ", e.code, e.reason)
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
+        )
     # validate sender and recipient's email addresses
     if "none@domain.com" not in SENDER and RECIPIENT:
-        try:
-            print("Sending the alert to the emails")
-            send_org_email(event_details, event_type, affected_org_accounts, resources)
-        except HTTPError as e:
-            print("Got an error while sending message to Email: ", e.code, e.reason)
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
+        email_sender = send_org_email if is_org_mode else send_email
+        channels.append(
+            (
+                "Email",
+                lambda deadline: email_sender(
+                    event_details, event_type, affected_accounts, resources
+                ),
+            )
+        )
     if "hooks.chime.aws/incomingwebhooks" in chime_url:
-        try:
-            print("Sending the alert to Chime channel")
-            send_to_chime(
-                get_org_message_for_chime(
-                    event_details, event_type, affected_org_accounts, resources
+        get_chime_message = (
+            get_org_message_for_chime if is_org_mode else get_message_for_chime
+        )
+        channels.append(
+            (
+                "Chime",
+                lambda deadline: send_to_chime(
+                    get_chime_message(
+                        event_details, event_type, affected_accounts, resources
+                    ),
+                    chime_url,
+                    deadline,
                 ),
-                chime_url,
             )
-        except HTTPError as e:
-            print("Got an error while sending message to Chime: ", e.code, e.reason)
-        except URLError as e:
-            print("Server connection failed: ", e.reason)
-            pass
+        )
+    return channels
+
+
+# send to all channels concurrently so the alert takes as long as the slowest channel,
+# each channel gets ALERT_CHANNEL_TIMEOUT seconds and reports its outcome and latency.
+# A channel that only buffers the alert, like EventBridge, returns True and is reported
+# as queued, its delivery is reported when the buffer is flushed
+@metrics.timed("Alerts")
+def dispatch_alert(channels):
+    results = {}
+    if not channels:
+        return results
+
+    def deliver(channel):
+        name, send = channel
+        started = time.monotonic()
+        logger.debug("Sending the alert to %s", name)
+        try:
+            with metrics.stage(f"Alert.{name}"):
+                queued = bool(send(deadline))
+        except WebhookError as e:
+            error = str(e)
+        except urllib3.exceptions.HTTPError as e:
+            error = f"Server connection failed: {e}"
+        except Exception as e:
+            error = repr(e)
+        else:
+            error = None
+        return {
+            "success": error is None,
+            "queued": error is None and queued,
+            "latency_ms": round((time.monotonic() - started) * 1000),
+            "error": error,
+        }
+
+    started = time.monotonic()
+    timeout = channel_timeout()
+    deadline = started + timeout
+    executor = ThreadPoolExecutor(max_workers=len(channels))
+    futures = {executor.submit(deliver, channel): channel[0] for channel in channels}
+    for future, name in futures.items():
+        try:
+            results[name] = future.result(
+                timeout=max(0, timeout - (time.monotonic() - started))
+            )
+        except TimeoutError:
+            results[name] = {
+                "success": False,
+                "queued": False,
+                "latency_ms": round((time.monotonic() - started) * 1000),
+                "error": f"timed out after {timeout}s",
+            }
+    # a send that timed out can't be interrupted, it keeps running in the background
+    # and may still deliver the alert after it was reported as timed out, while the next
+    # alert or invocation goes on. Webhook sends stop retrying at the deadline, sends
+    # that haven't started yet are cancelled
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for name, result in results.items():
+        if result["queued"]:
+            logger.info(
+                "Alert queued for %s", name, extra={"latency_ms": result["latency_ms"]}
+            )
+        elif result["success"]:
+            logger.info(
+                "Alert sent to %s", name, extra={"latency_ms": result["latency_ms"]}
+            )
+        else:
+            logger.error(
+                "Got an error while sending message to %s",
+                name,
+                extra={"latency_ms": result["latency_ms"], "error": result["error"]},
+            )
+    return results
+
 
+def channel_timeout():
+    return float(os.environ.get("ALERT_CHANNEL_TIMEOUT", "10"))
 
-def send_to_slack(message, webhookurl):
+
+def send_to_slack(message, webhookurl, deadline=None):
     slack_message = message
-    req = Request(
+    webhook_client.post_json(
         webhookurl,
-        data=json.dumps(slack_message).encode("utf-8"),
+        slack_message,
         headers={"content-type": "application/json"},
+        deadline=deadline,
     )
-    try:
-        response = urlopen(req)
-        response.read()
-    except HTTPError as e:
-        print("Request failed : ", e.code, e.reason)
-    except URLError as e:
-        print("Server connection failed: ", e.reason, e.reason)
 
 
-def send_to_chime(message, webhookurl):
+def send_to_chime(message, webhookurl, deadline=None):
     chime_message = {"Content": message}
-    req = Request(
+    webhook_client.post_json(
         webhookurl,
-        data=json.dumps(chime_message).encode("utf-8"),
+        chime_message,
         headers={"content-Type": "application/json"},
+        deadline=deadline,
     )
-    try:
-        response = urlopen(req)
-        response.read()
-    except HTTPError as e:
-        print("Request failed : ", e.code, e.reason)
-    except URLError as e:
-        print("Server connection failed: ", e.reason, e.reason)
 
 
-def send_to_teams(message, webhookurl):
+def send_to_teams(message, webhookurl, deadline=None):
     teams_message = message
-    req = Request(
+    webhook_client.post_json(
         webhookurl,
-        data=json.dumps(teams_message).encode("utf-8"),
+        teams_message,
         headers={"content-type": "application/json"},
+        deadline=deadline,
     )
-    try:
-        response = urlopen(req)
-        response.read()
-    except HTTPError as e:
-        print("Request failed : ", e.code, e.reason)
-    except URLError as e:
-        print("Server connection failed: ", e.reason, e.reason)
 
 
 def send_email(event_details, eventType, affected_accounts, affected_entities):
@@ -378,6 +1174,7 @@ def send_org_email(
 
 
 # non-organization view affected accounts
+@metrics.timed("AffectedAccounts")
 def get_health_accounts(health_client, event, event_arn):
     affected_accounts = []
     event_accounts_paginator = health_client.get_paginator("describe_affected_entities")
@@ -385,8 +1182,7 @@ def get_health_accounts(health_client, event, event_arn):
         filter={"eventArns": [event_arn]}
     )
     for event_accounts_page in event_accounts_page_iterator:
-        json_event_accounts = json.dumps(event_accounts_page, default=myconverter)
-        parsed_event_accounts = json.loads(json_event_accounts)
+        parsed_event_accounts = normalize_datetimes(event_accounts_page)
         try:
             affected_accounts.append(
                 parsed_event_accounts["entities"][0]["awsAccountId"]
@@ -396,62 +1192,98 @@ def get_health_accounts(health_client, event, event_arn):
     return affected_accounts
 
 
-# organization view affected accounts
-def get_health_org_accounts(health_client, event, event_arn):
-    affected_org_accounts = []
+# organization view affected accounts, streamed page by page
+def iter_health_org_accounts(health_client, event_arn):
     event_accounts_paginator = health_client.get_paginator(
         "describe_affected_accounts_for_organization"
     )
     event_accounts_page_iterator = event_accounts_paginator.paginate(eventArn=event_arn)
-    for event_accounts_page in event_accounts_page_iterator:
-        json_event_accounts = json.dumps(event_accounts_page, default=myconverter)
-        parsed_event_accounts = json.loads(json_event_accounts)
-        affected_org_accounts = affected_org_accounts + (
-            parsed_event_accounts["affectedAccounts"]
-        )
-    return affected_org_accounts
+    for event_accounts_page in metrics.timed_iter(
+        "AffectedAccounts", event_accounts_page_iterator
+    ):
+        yield from event_accounts_page["affectedAccounts"]
+
+
+# organization view affected accounts as a sorted list of unique account ids
+def get_health_org_accounts(health_client, event, event_arn):
+    return sorted(set(iter_health_org_accounts(health_client, event_arn)))
 
 
 # get the array of affected entities for all affected accounts and return as an array of JSON objects
+@metrics.timed("AffectedEntities")
 def get_affected_entities(health_client, event_arn, affected_accounts, is_org_mode):
+    if is_org_mode:
+        return list(
+            iter_org_affected_entities(health_client, event_arn, affected_accounts)
+        )
+
     affected_entity_array = []
 
     for account in affected_accounts:
-        account_name = ""
-        if is_org_mode:
-            event_entities_paginator = health_client.get_paginator(
-                "describe_affected_entities_for_organization"
-            )
-            event_entities_page_iterator = event_entities_paginator.paginate(
-                organizationEntityFilters=[
-                    {"awsAccountId": account, "eventArn": event_arn}
-                ]
-            )
-            account_name = get_account_name(account)
-        else:
-            event_entities_paginator = health_client.get_paginator(
-                "describe_affected_entities"
-            )
-            event_entities_page_iterator = event_entities_paginator.paginate(
-                filter={"eventArns": [event_arn]}
-            )
+        event_entities_paginator = health_client.get_paginator(
+            "describe_affected_entities"
+        )
+        event_entities_page_iterator = event_entities_paginator.paginate(
+            filter={"eventArns": [event_arn]}
+        )
 
         for event_entities_page in event_entities_page_iterator:
-            json_event_entities = json.dumps(event_entities_page, default=myconverter)
-            parsed_event_entities = json.loads(json_event_entities)
+            parsed_event_entities = normalize_datetimes(event_entities_page)
             for entity in parsed_event_entities["entities"]:
                 entity.pop(
                     "entityArn"
                 )  # remove entityArn to avoid confusion with the arn of the entityValue (not present)
                 entity.pop("eventArn")  # remove eventArn duplicate of detail.arn
                 entity.pop("lastUpdatedTime")  # remove for brevity
-                if is_org_mode:
-                    entity["awsAccountName"] = account_name
                 affected_entity_array.append(entity)
 
     return affected_entity_array
 
 
+# organization view affected entities, the accounts are packed into filter lists of the
+# maximum size the api accepts and the batches are fetched concurrently, in account order
+def iter_org_affected_entities(health_client, event_arn, affected_org_accounts):
+    account_batches = [
+        affected_org_accounts[i : i + ORG_ENTITY_FILTER_LIMIT]
+        for i in range(0, len(affected_org_accounts), ORG_ENTITY_FILTER_LIMIT)
+    ]
+
+    def fetch_batch(accounts):
+        entities = []
+        event_entities_paginator = health_client.get_paginator(
+            "describe_affected_entities_for_organization"
+        )
+        event_entities_page_iterator = event_entities_paginator.paginate(
+            organizationEntityFilters=[
+                {"awsAccountId": account, "eventArn": event_arn} for account in accounts
+            ]
+        )
+        for event_entities_page in event_entities_page_iterator:
+            parsed_event_entities = normalize_datetimes(event_entities_page)
+            for failed in parsed_event_entities.get("failedSet", []):
+                logger.warning(
+                    "An error occured with account %s",
+                    failed.get("awsAccountId"),
+                    extra={
+                        "error_name": failed.get("errorName"),
+                        "error": failed.get("errorMessage"),
+                    },
+                )
+            for entity in parsed_event_entities["entities"]:
+                entity.pop(
+                    "entityArn"
+                )  # remove entityArn to avoid confusion with the arn of the entityValue (not present)
+                entity.pop("eventArn")  # remove eventArn duplicate of detail.arn
+                entity.pop("lastUpdatedTime")  # remove for brevity
+                entity["awsAccountName"] = get_account_name(entity["awsAccountId"])
+                entities.append(entity)
+        return entities
+
+    max_workers = int(os.environ.get("ENTITY_WORKERS", "4"))
+    for entities in map_bounded(fetch_batch, account_batches, max_workers):
+        yield from entities
+
+
 # COMMON
 # get the entityValues from the array and return as an array (of strings) for use with chat channels
 # don't list entities which are accounts (handled separately for chat applications)
@@ -479,110 +1311,35 @@ def update_org_ddb(
     affected_org_accounts,
     affected_org_entities,
 ):
-    # open dynamoDB
-    dynamodb = aws_api.resource("dynamodb")
-    ddb_table = os.environ["DYNAMODB_TABLE"]
-    aha_ddb_table = dynamodb.Table(ddb_table)
-    event_latestDescription = event_details["successfulSet"][0]["eventDescription"][
-        "latestDescription"
-    ]
-    # set time parameters
-    delta_hours = os.environ["EVENT_SEARCH_BACK"]
-    delta_hours = int(delta_hours)
-    delta_hours_sec = delta_hours * 3600
-
-    # formatting time in seconds
-    srt_ddb_format_full = "%Y-%m-%d %H:%M:%S"
-    str_ddb_format_sec = "%s"
-    sec_now = datetime.strftime(datetime.now(), str_ddb_format_sec)
-
-    # check if event arn already exists
-    try:
-        response = aha_ddb_table.get_item(Key={"arn": event_arn})
-    except ClientError as e:
-        print(e.response["Error"]["Message"])
-    else:
-        is_item_response = response.get("Item")
-        if is_item_response == None:
-            print(datetime.now().strftime(srt_ddb_format_full) + ": record not found")
-            # write to dynamodb
-            response = aha_ddb_table.put_item(
-                Item={
-                    "arn": event_arn,
-                    "lastUpdatedTime": str_update,
-                    "added": sec_now,
-                    "ttl": int(sec_now) + delta_hours_sec + 86400,
-                    "statusCode": status_code,
-                    "affectedAccountIDs": affected_org_accounts,
-                    "latestDescription": event_latestDescription
-                    # Cleanup: DynamoDB entry deleted 24 hours after last update
-                }
+    def send_to_endpoints():
+        affected_org_accounts_details = [
+            f"{get_account_name(account_id)} ({account_id})"
+            for account_id in affected_org_accounts
+        ]
+        # send to configured endpoints
+        if status_code != "closed":
+            send_org_alert(
+                event_details,
+                affected_org_accounts_details,
+                affected_org_entities,
+                event_type="create",
             )
-            affected_org_accounts_details = [
-                f"{get_account_name(account_id)} ({account_id})"
-                for account_id in affected_org_accounts
-            ]
-            # send to configured endpoints
-            if status_code != "closed":
-                send_org_alert(
-                    event_details,
-                    affected_org_accounts_details,
-                    affected_org_entities,
-                    event_type="create",
-                )
-            else:
-                send_org_alert(
-                    event_details,
-                    affected_org_accounts_details,
-                    affected_org_entities,
-                    event_type="resolve",
-                )
-
         else:
-            item = response["Item"]
-            if item["lastUpdatedTime"] != str_update and (
-                item["statusCode"] != status_code
-                or item["latestDescription"] != event_latestDescription
-                or item["affectedAccountIDs"] != affected_org_accounts
-            ):
-                print(
-                    datetime.now().strftime(srt_ddb_format_full)
-                    + ": last Update is different"
-                )
-                # write to dynamodb
-                response = aha_ddb_table.put_item(
-                    Item={
-                        "arn": event_arn,
-                        "lastUpdatedTime": str_update,
-                        "added": sec_now,
-                        "ttl": int(sec_now) + delta_hours_sec + 86400,
-                        "statusCode": status_code,
-                        "affectedAccountIDs": affected_org_accounts,
-                        "latestDescription": event_latestDescription
-                        # Cleanup: DynamoDB entry deleted 24 hours after last update
-                    }
-                )
-                affected_org_accounts_details = [
-                    f"{get_account_name(account_id)} ({account_id})"
-                    for account_id in affected_org_accounts
-                ]
-                # send to configured endpoints
-                if status_code != "closed":
-                    send_org_alert(
-                        event_details,
-                        affected_org_accounts_details,
-                        affected_org_entities,
-                        event_type="create",
-                    )
-                else:
-                    send_org_alert(
-                        event_details,
-                        affected_org_accounts_details,
-                        affected_org_entities,
-                        event_type="resolve",
-                    )
-            else:
-                print("No new updates found, checking again in 1 minute.")
+            send_org_alert(
+                event_details,
+                affected_org_accounts_details,
+                affected_org_entities,
+                event_type="resolve",
+            )
+
+    put_event_state(
+        event_arn,
+        str_update,
+        status_code,
+        event_details,
+        affected_org_accounts,
+        send_to_endpoints,
+    )
 
 
 # For Customers not using AWS Organizations
@@ -594,10 +1351,61 @@ def update_ddb(
     affected_accounts,
     affected_entities,
 ):
-    # open dynamoDB
-    dynamodb = aws_api.resource("dynamodb")
-    ddb_table = os.environ["DYNAMODB_TABLE"]
-    aha_ddb_table = dynamodb.Table(ddb_table)
+    def send_to_endpoints():
+        affected_accounts_details = affected_accounts
+        # send to configured endpoints
+        if status_code != "closed":
+            send_alert(
+                event_details,
+                affected_accounts_details,
+                affected_entities,
+                event_type="create",
+            )
+        else:
+            send_alert(
+                event_details,
+                affected_accounts_details,
+                affected_entities,
+                event_type="resolve",
+            )
+
+    put_event_state(
+        event_arn,
+        str_update,
+        status_code,
+        event_details,
+        affected_accounts,
+        send_to_endpoints,
+    )
+
+
+# order independent fingerprint of a set of account ids
+def get_accounts_fingerprint(account_ids):
+    return hashlib.sha256("\n".join(sorted(set(account_ids))).encode("utf-8")).hexdigest()
+
+
+# store the event state and call send_to_endpoints when it is new, or has a new
+# lastUpdatedTime along with a new status, description or set of accounts. By default the
+# check is a single conditional put, so Lambdas in both regions of a GlobalTable deployment
+# can't both win the same update. With DDB_WRITE_MODE=batch the check is made against the
+# record preloaded for the page and the write goes through the BatchWriteItem buffer, the
+# alert is only sent once the write has been acknowledged
+def put_event_state(
+    event_arn, str_update, status_code, event_details, affected_accounts, send_to_endpoints
+):
+    item = get_event_state_item(
+        event_arn, str_update, status_code, event_details, affected_accounts
+    )
+    if (
+        os.environ.get("DDB_WRITE_MODE", "conditional") == "batch"
+        and event_arn in preloaded_event_items
+    ):
+        buffer_event_state(item, preloaded_event_items[event_arn], send_to_endpoints)
+    elif put_event_state_conditionally(item):
+        send_to_endpoints()
+
+
+def get_event_state_item(event_arn, str_update, status_code, event_details, affected_accounts):
     event_latestDescription = event_details["successfulSet"][0]["eventDescription"][
         "latestDescription"
     ]
@@ -608,129 +1416,249 @@ def update_ddb(
     delta_hours_sec = delta_hours * 3600
 
     # formatting time in seconds
-    srt_ddb_format_full = "%Y-%m-%d %H:%M:%S"
     str_ddb_format_sec = "%s"
     sec_now = datetime.strftime(datetime.now(), str_ddb_format_sec)
 
-    # check if event arn already exists
+    item = {
+        "arn": event_arn,
+        "lastUpdatedTime": str_update,
+        "added": sec_now,
+        "ttl": int(sec_now) + delta_hours_sec + 86400,
+        "statusCode": status_code,
+        "latestDescription": event_latestDescription,
+        "descriptionHash": hashlib.sha256(
+            event_latestDescription.encode("utf-8")
+        ).hexdigest(),
+        # Cleanup: DynamoDB entry deleted 24 hours after last update
+        # the accounts are always compared by fingerprint, so their order doesn't matter
+        "affectedAccountsHash": get_accounts_fingerprint(affected_accounts),
+        "affectedAccountCount": len(set(affected_accounts)),
+    }
+    if os.environ.get("ACCOUNT_FINGERPRINT", "False") == "True":
+        # org-wide events would otherwise grow the item towards the 400 KB limit
+        if os.environ.get("STORE_COMPRESSED_ACCOUNTS", "False") == "True":
+            item["affectedAccountIDsZ"] = zlib.compress(
+                json.dumps(sorted(set(affected_accounts))).encode("utf-8")
+            )
+    else:
+        item["affectedAccountIDs"] = affected_accounts
+    return item
+
+
+@metrics.timed("StateWrite")
+def put_event_state_conditionally(item):
     try:
-        response = aha_ddb_table.get_item(Key={"arn": event_arn})
+        if state_store.put_event_state_if_changed(item):
+            logger.info("New or updated event", extra={"event_arn": item["arn"]})
+            remember_event_state(item["arn"], item["lastUpdatedTime"], item["statusCode"])
+            return True
+        logger.info(
+            "No new updates found, checking again in 1 minute.",
+            extra={"event_arn": item["arn"], "sample": True},
+        )
+        # keep the lastUpdatedTime of updates that don't warrant an alert so the next
+        # polls can skip the event straight from the listing
+        if state_store.touch_event_state(
+            item["arn"], item["lastUpdatedTime"], item["statusCode"]
+        ):
+            remember_event_state(item["arn"], item["lastUpdatedTime"], item["statusCode"])
     except ClientError as e:
-        print(e.response["Error"]["Message"])
+        logger.error(
+            "Unable to store the event state",
+            extra={"event_arn": item["arn"], "error": e.response["Error"]["Message"]},
+        )
+        state_writer.drop()
+    return False
+
+
+# same rule as the conditional put, evaluated against the preloaded record. Records
+# written before the fingerprints were stored are compared by their account list and
+# description
+def is_event_state_changed(item, stored_item):
+    if stored_item is None:
+        return True
+    if stored_item.get("lastUpdatedTime") == item["lastUpdatedTime"]:
+        return False
+    stored_accounts_hash = stored_item.get("affectedAccountsHash")
+    if stored_accounts_hash is None and "affectedAccountIDs" in stored_item:
+        stored_accounts_hash = get_accounts_fingerprint(stored_item["affectedAccountIDs"])
+    if "descriptionHash" in stored_item:
+        description_changed = stored_item["descriptionHash"] != item["descriptionHash"]
     else:
-        is_item_response = response.get("Item")
-        if is_item_response == None:
-            print(datetime.now().strftime(srt_ddb_format_full) + ": record not found")
-            # write to dynamodb
-            response = aha_ddb_table.put_item(
-                Item={
-                    "arn": event_arn,
-                    "lastUpdatedTime": str_update,
-                    "added": sec_now,
-                    "ttl": int(sec_now) + delta_hours_sec + 86400,
-                    "statusCode": status_code,
-                    "affectedAccountIDs": affected_accounts,
-                    "latestDescription": event_latestDescription
-                    # Cleanup: DynamoDB entry deleted 24 hours after last update
-                }
-            )
+        description_changed = stored_item.get("latestDescription") != item["latestDescription"]
+    return (
+        stored_item.get("statusCode") != item["statusCode"]
+        or stored_accounts_hash != item["affectedAccountsHash"]
+        or description_changed
+    )
 
-            affected_accounts_details = affected_accounts
 
-            # send to configured endpoints
-            if status_code != "closed":
-                send_alert(
-                    event_details,
-                    affected_accounts_details,
-                    affected_entities,
-                    event_type="create",
-                )
-            else:
-                send_alert(
-                    event_details,
-                    affected_accounts_details,
-                    affected_entities,
-                    event_type="resolve",
-                )
-        else:
-            item = response["Item"]
-            if item["lastUpdatedTime"] != str_update and (
-                item["statusCode"] != status_code
-                or item["latestDescription"] != event_latestDescription
-                or item["affectedAccountIDs"] != affected_accounts
-            ):
-                print(
-                    datetime.now().strftime(srt_ddb_format_full)
-                    + ": last Update is different"
+def buffer_event_state(item, stored_item, send_to_endpoints):
+    def on_commit():
+        remember_event_state(item["arn"], item["lastUpdatedTime"], item["statusCode"])
+        send_to_endpoints()
+
+    if is_event_state_changed(item, stored_item):
+        state_writer.add(item, on_commit)
+        return
+    logger.info(
+        "No new updates found, checking again in 1 minute.",
+        extra={"event_arn": item["arn"], "sample": True},
+    )
+    if (
+        stored_item.get("lastUpdatedTime") != item["lastUpdatedTime"]
+        and stored_item.get("statusCode") == item["statusCode"]
+    ):
+        # keep the lastUpdatedTime of updates that don't warrant an alert
+        state_writer.add(
+            dict(stored_item, lastUpdatedTime=item["lastUpdatedTime"]),
+            lambda: remember_event_state(
+                item["arn"], item["lastUpdatedTime"], item["statusCode"]
+            ),
+        )
+
+
+# BatchWriteItem writes up to 25 items per call
+DDB_BATCH_WRITE_LIMIT = 25
+
+
+# write-behind buffer for event state, items are written with BatchWriteItem in groups
+# of 25 and each item's on_commit callback only runs once its write is acknowledged.
+# Items still unprocessed after the retries are counted in dropped, along with events
+# whose details or state couldn't be fetched or stored. The poll watermark isn't moved
+# while anything was dropped, so those events are picked up again by the next poll
+class StateWriter:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pending = []
+        self.dropped = 0
+        self.max_attempts = int(os.environ.get("DDB_WRITE_MAX_ATTEMPTS", "5"))
+
+    def add(self, item, on_commit):
+        with self.lock:
+            # a batch can't hold two writes to the same key
+            if any(pending_item["arn"] == item["arn"] for pending_item, _ in self.pending):
+                self.flush()
+            self.pending.append((item, on_commit))
+            if len(self.pending) >= DDB_BATCH_WRITE_LIMIT:
+                self.flush()
+
+    @metrics.timed("StateWrite")
+    def flush(self):
+        with self.lock:
+            while self.pending:
+                batch = self.pending[:DDB_BATCH_WRITE_LIMIT]
+                self.pending = self.pending[DDB_BATCH_WRITE_LIMIT:]
+                self.write_batch(batch)
+
+    def write_batch(self, batch):
+        unwritten = {item["arn"]: (item, on_commit) for item, on_commit in batch}
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                unprocessed_arns = state_store.put_items(
+                    [item for item, _ in unwritten.values()]
                 )
-                # write to dynamodb
-                response = aha_ddb_table.put_item(
-                    Item={
-                        "arn": event_arn,
-                        "lastUpdatedTime": str_update,
-                        "added": sec_now,
-                        "ttl": int(sec_now) + delta_hours_sec + 86400,
-                        "statusCode": status_code,
-                        "affectedAccountIDs": affected_accounts,
-                        "latestDescription": event_latestDescription
-                        # Cleanup: DynamoDB entry deleted 24 hours after last update
-                    }
+            except ClientError as e:
+                logger.warning(
+                    "Got an error while writing event states",
+                    extra={"error": e.response["Error"]["Message"]},
                 )
-                affected_accounts_details = [
-                    f"{get_account_name(account_id)} ({account_id})"
-                    for account_id in affected_accounts
-                ]
-                # send to configured endpoints
-                if status_code != "closed":
-                    send_alert(
-                        event_details,
-                        affected_accounts_details,
-                        affected_entities,
-                        event_type="create",
-                    )
-                else:
-                    send_alert(
-                        event_details,
-                        affected_accounts_details,
-                        affected_entities,
-                        event_type="resolve",
-                    )
-            else:
-                print("No new updates found, checking again in 1 minute.")
+                unprocessed_arns = set(unwritten)
+            for arn in [arn for arn in unwritten if arn not in unprocessed_arns]:
+                _, on_commit = unwritten.pop(arn)
+                on_commit()
+            if not unwritten:
+                return
+            if attempt < self.max_attempts:
+                time.sleep(random.uniform(0, min(2, 0.05 * 2**attempt)))
+        logger.error(
+            "%d event states could not be written after %d attempts, no alert was sent",
+            len(unwritten),
+            self.max_attempts,
+            extra={"event_arns": list(unwritten)},
+        )
+        self.drop(len(unwritten))
+
+    def drop(self, count=1):
+        with self.lock:
+            self.dropped += count
+
+
+state_writer = StateWriter()
+
+
+# secrets resolved with a single BatchGetSecretValue call and shared as one read-only
+# snapshot, reloaded at the start of an invocation once the TTL has passed so rotated
+# webhook urls are picked up by warm containers
+class SecretsCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.fetched = 0
+
+    def begin_invocation(self):
+        with self.lock:
+            if self.snapshot is None or time.time() - self.fetched >= self.ttl:
+                self.reload()
+
+    def get(self):
+        with self.lock:
+            if self.snapshot is None:
+                self.reload()
+            return self.snapshot
+
+    def reload(self):
+        self.snapshot = MappingProxyType(load_secrets())
+        self.fetched = time.time()
+
+
+secrets_cache = SecretsCache(int(os.environ.get("SECRETS_CACHE_TTL", "300")))
 
 
 def get_secrets():
-    secret_teams_name = "MicrosoftChannelID"
-    secret_slack_name = "SlackChannelID"
-    secret_chime_name = "ChimeChannelID"
+    return secrets_cache.get()
+
+
+def load_secrets():
+    # secrets key -> (secret name, whether it is configured)
+    secret_names = {
+        "teams": ("MicrosoftChannelID", "Teams" in os.environ),
+        "slack": ("SlackChannelID", "Slack" in os.environ),
+        "chime": ("ChimeChannelID", "Chime" in os.environ),
+        "ahaassumerole": ("AssumeRoleArn", os.environ["MANAGEMENT_ROLE_ARN"] != "None"),
+        "eventbusname": ("EventBusName", "Eventbridge" in os.environ),
+    }
     region_name = os.environ["AWS_REGION"]
-    event_bus_name = "EventBusName"
-    secret_assumerole_name = "AssumeRoleArn"
-    secrets = {}
+    secrets = {key: "None" for key in secret_names}
+    configured = {
+        secret_name: key
+        for key, (secret_name, is_configured) in secret_names.items()
+        if is_configured
+    }
+    if not configured:
+        return secrets
 
     # create a Secrets Manager client
-    client = aws_api.secretsmanager(region_name=region_name)
-    # Iteration through the configured AWS Secrets
-    secrets["teams"] = (
-        get_secret(secret_teams_name, client) if "Teams" in os.environ else "None"
-    )
-    secrets["slack"] = (
-        get_secret(secret_slack_name, client) if "Slack" in os.environ else "None"
-    )
-    secrets["chime"] = (
-        get_secret(secret_chime_name, client) if "Chime" in os.environ else "None"
-    )
-    secrets["ahaassumerole"] = (
-        get_secret(secret_assumerole_name, client)
-        if os.environ["MANAGEMENT_ROLE_ARN"] != "None"
-        else "None"
-    )
-    secrets["eventbusname"] = (
-        get_secret(event_bus_name, client) if "Eventbridge" in os.environ else "None"
-    )
+    client = aws_api.client("secretsmanager", region_name=region_name)
+    try:
+        response = client.batch_get_secret_value(SecretIdList=list(configured))
+    except ClientError as e:
+        logger.warning(
+            "Unable to batch get secrets, getting them one by one",
+            extra={"error": e.response["Error"]},
+        )
+        for secret_name, key in configured.items():
+            secrets[key] = get_secret(secret_name, client)
+    else:
+        for secret in response["SecretValues"]:
+            secrets[configured[secret["Name"]]] = secret.get("SecretString", "None")
+        for error in response.get("Errors", []):
+            logger.error(
+                "There was an error with the %s secret", error["SecretId"], extra={"error": error}
+            )
 
-    # uncomment below to verify secrets values
-    # print("Secrets: ",secrets)
+    logger.debug("Loaded secrets", extra={"secrets": sorted(secrets)})
     return secrets
 
 
@@ -738,55 +1666,57 @@ def get_secret(secret_name, client):
     try:
         get_secret_value_response = client.get_secret_value(SecretId=secret_name)
     except ClientError as e:
-        print(f"There was an error with the {secret_name} secret: ", e.response)
+        logger.error(
+            "There was an error with the %s secret", secret_name, extra={"error": e.response}
+        )
         return "None"
-    finally:
-        if "SecretString" not in get_secret_value_response:
-            return "None"
 
-        return get_secret_value_response["SecretString"]
+    if "SecretString" not in get_secret_value_response:
+        return "None"
+
+    return get_secret_value_response["SecretString"]
 
 
 def describe_events(health_client):
-    str_ddb_format_sec = "%s"
     # set hours to search back in time for events
     delta_hours = os.environ["EVENT_SEARCH_BACK"]
     health_event_type = os.environ["HEALTH_EVENT_TYPE"]
     delta_hours = int(delta_hours)
-    time_delta = datetime.now() - timedelta(hours=delta_hours)
-    print("Searching for events and updates made after: ", time_delta)
+    poll_started = datetime.now()
+    time_delta, full_scan = get_poll_window(poll_started, delta_hours)
+    logger.info("Searching for events and updates made after %s", time_delta)
     dict_regions = os.environ["REGIONS"]
 
     str_filter = {"lastUpdatedTimes": [{"from": time_delta}]}
 
     if health_event_type == "issue":
         event_type_filter = {"eventTypeCategories": ["issue", "investigation"]}
-        print(
+        logger.info(
             "AHA will be monitoring events with event type categories as 'issue' only!"
         )
         str_filter.update(event_type_filter)
 
     if dict_regions != "all regions":
         dict_regions = [region.strip() for region in dict_regions.split(",")]
-        print(
-            "AHA will monitor for events only in the selected regions: ", dict_regions
+        logger.info(
+            "AHA will monitor for events only in the selected regions",
+            extra={"regions": dict_regions},
         )
         region_filter = {"regions": dict_regions}
         str_filter.update(region_filter)
 
     event_paginator = health_client.get_paginator("describe_events")
     event_page_iterator = event_paginator.paginate(filter=str_filter)
-    for response in event_page_iterator:
+    for response in metrics.timed_iter("DescribeEvents", event_page_iterator):
         events = response.get("events", [])
-        aws_events = json.dumps(events, default=myconverter)
-        aws_events = json.loads(aws_events)
-        print("Event(s) Received: ", json.dumps(aws_events))
+        aws_events = normalize_datetimes(events)
+        logger.info("%d event(s) received", len(aws_events))
+        logger.debug("Event(s) received", extra={"events": aws_events})
         if len(aws_events) > 0:  # if there are new event(s) from AWS
-            for event in aws_events:
+            for event in get_updated_events(aws_events):
                 event_arn = event["arn"]
                 status_code = event["statusCode"]
-                str_update = parser.parse((event["lastUpdatedTime"]))
-                str_update = str_update.strftime(str_ddb_format_sec)
+                str_update = get_event_update_time(event)
 
                 # get non-organizational view requirements
                 affected_accounts = get_health_accounts(health_client, event, event_arn)
@@ -795,21 +1725,20 @@ def describe_events(health_client):
                 )
 
                 # get event details
-                event_details = json.dumps(
-                    describe_event_details(health_client, event_arn),
-                    default=myconverter,
+                event_details = normalize_datetimes(
+                    describe_event_details(health_client, event_arn)
                 )
-                event_details = json.loads(event_details)
-                print("Event Details: ", event_details)
+                logger.debug("Event details", extra={"event_details": event_details})
                 if event_details["successfulSet"] == []:
-                    print(
-                        "An error occured with account:",
+                    logger.error(
+                        "An error occured with account %s",
                         event_details["failedSet"][0]["awsAccountId"],
-                        "due to:",
-                        event_details["failedSet"][0]["errorName"],
-                        ":",
-                        event_details["failedSet"][0]["errorMessage"],
+                        extra={
+                            "error_name": event_details["failedSet"][0]["errorName"],
+                            "error": event_details["failedSet"][0]["errorMessage"],
+                        },
                     )
+                    state_writer.drop()
                     continue
                 else:
                     # write to dynamoDB for persistence
@@ -822,115 +1751,475 @@ def describe_events(health_client):
                         affected_entities,
                     )
         else:
-            print("No events found in time frame, checking again in 1 minute.")
+            logger.info("No events found in time frame, checking again in 1 minute.")
+        # write the buffered event states of the page and send their alerts
+        state_writer.flush()
+
+    if state_writer.dropped == 0:
+        save_poll_watermark(poll_started, full_scan)
+    else:
+        logger.warning(
+            "Not moving the poll watermark, %d event(s) will be retried by the next poll",
+            state_writer.dropped,
+        )
 
 
 def describe_org_events(health_client):
-    str_ddb_format_sec = "%s"
     # set hours to search back in time for events
     delta_hours = os.environ["EVENT_SEARCH_BACK"]
     health_event_type = os.environ["HEALTH_EVENT_TYPE"]
     dict_regions = os.environ["REGIONS"]
     delta_hours = int(delta_hours)
-    time_delta = datetime.now() - timedelta(hours=delta_hours)
-    print("Searching for events and updates made after: ", time_delta)
+    poll_started = datetime.now()
+    time_delta, full_scan = get_poll_window(poll_started, delta_hours)
+    logger.info("Searching for events and updates made after %s", time_delta)
 
     str_filter = {"lastUpdatedTime": {"from": time_delta}}
 
     if health_event_type == "issue":
         event_type_filter = {"eventTypeCategories": ["issue", "investigation"]}
-        print(
+        logger.info(
             "AHA will be monitoring events with event type categories as 'issue' only!"
         )
         str_filter.update(event_type_filter)
 
     if dict_regions != "all regions":
         dict_regions = [region.strip() for region in dict_regions.split(",")]
-        print(
-            "AHA will monitor for events only in the selected regions: ", dict_regions
+        logger.info(
+            "AHA will monitor for events only in the selected regions",
+            extra={"regions": dict_regions},
         )
         region_filter = {"regions": dict_regions}
         str_filter.update(region_filter)
 
+    # load the account exclusion list once per invocation
+    if os.environ["ACCOUNT_IDS"] == "None" or os.environ["ACCOUNT_IDS"] == "":
+        account_ids_to_filter = None
+    else:
+        account_ids_to_filter = getAccountIDs()
+
     org_event_paginator = health_client.get_paginator(
         "describe_events_for_organization"
     )
     org_event_page_iterator = org_event_paginator.paginate(filter=str_filter)
-    for response in org_event_page_iterator:
+    for response in metrics.timed_iter("DescribeEvents", org_event_page_iterator):
         events = response.get("events", [])
-        aws_events = json.dumps(events, default=myconverter)
-        aws_events = json.loads(aws_events)
-        print("Event(s) Received: ", json.dumps(aws_events))
+        aws_events = normalize_datetimes(events)
+        logger.info("%d event(s) received", len(aws_events))
+        logger.debug("Event(s) received", extra={"events": aws_events})
         if len(aws_events) > 0:
-            for event in aws_events:
-                event_arn = event["arn"]
-                status_code = event["statusCode"]
-                str_update = parser.parse((event["lastUpdatedTime"]))
-                str_update = str_update.strftime(str_ddb_format_sec)
+            # fetch accounts, entities and details concurrently, and update dynamoDB
+            # and send alerts in the order the events were listed as each one arrives
+            org_events = map_events(
+                lambda event: fetch_org_event(
+                    health_client, event, account_ids_to_filter
+                ),
+                get_updated_events(aws_events),
+            )
+            for org_event in org_events:
+                if org_event is not None:
+                    update_org_ddb(*org_event)
+        else:
+            logger.info("No events found in time frame, checking again in 1 minute.")
+        # write the buffered event states of the page and send their alerts
+        state_writer.flush()
 
-                # get organizational view requirements
-                affected_org_accounts = get_health_org_accounts(
-                    health_client, event, event_arn
-                )
-                if (
-                    os.environ["ACCOUNT_IDS"] == "None"
-                    or os.environ["ACCOUNT_IDS"] == ""
-                ):
-                    affected_org_accounts = affected_org_accounts
-                    update_org_ddb_flag = True
-                else:
-                    account_ids_to_filter = getAccountIDs()
-                    if affected_org_accounts != []:
-                        focused_org_accounts = [
-                            i
-                            for i in affected_org_accounts
-                            if i not in account_ids_to_filter
-                        ]
-                        print("Focused list is ", focused_org_accounts)
-                        if focused_org_accounts != []:
-                            update_org_ddb_flag = True
-                            affected_org_accounts = focused_org_accounts
-                        else:
-                            update_org_ddb_flag = False
-                            print("Focused Organization Account list is empty")
-                    else:
-                        update_org_ddb_flag = True
-
-                affected_org_entities = get_affected_entities(
-                    health_client, event_arn, affected_org_accounts, is_org_mode=True
+    if state_writer.dropped == 0:
+        save_poll_watermark(poll_started, full_scan)
+    else:
+        logger.warning(
+            "Not moving the poll watermark, %d event(s) will be retried by the next poll",
+            state_writer.dropped,
+        )
+
+
+# gather the affected accounts, entities and details of a single organization event
+def fetch_org_event(health_client, event, account_ids_to_filter):
+    event_arn = event["arn"]
+    status_code = event["statusCode"]
+    str_update = get_event_update_time(event)
+
+    # get organizational view requirements, excluded accounts are dropped before
+    # any entity or detail lookups are made for them
+    if account_ids_to_filter is None:
+        affected_org_accounts = get_health_org_accounts(health_client, event, event_arn)
+    else:
+        total_org_accounts = 0
+        focused_org_accounts = set()
+        for account_id in iter_health_org_accounts(health_client, event_arn):
+            total_org_accounts += 1
+            if account_id not in account_ids_to_filter:
+                focused_org_accounts.add(account_id)
+        affected_org_accounts = sorted(focused_org_accounts)
+        if total_org_accounts > 0:
+            logger.debug(
+                "Focused list", extra={"event_arn": event_arn, "accounts": affected_org_accounts}
+            )
+            if affected_org_accounts == []:
+                logger.info(
+                    "Focused Organization Account list is empty",
+                    extra={"event_arn": event_arn, "sample": True},
                 )
-                # get event details
-                event_details = json.dumps(
-                    describe_org_event_details(
-                        health_client, event_arn, affected_org_accounts
-                    ),
-                    default=myconverter,
+                return None
+
+    affected_org_entities = get_affected_entities(
+        health_client, event_arn, affected_org_accounts, is_org_mode=True
+    )
+    # get event details
+    event_details = normalize_datetimes(
+        describe_org_event_details(health_client, event_arn, affected_org_accounts)
+    )
+    logger.debug("Event details", extra={"event_details": event_details})
+    if event_details["successfulSet"] == []:
+        logger.error(
+            "An error occured with account %s",
+            event_details["failedSet"][0]["awsAccountId"],
+            extra={
+                "error_name": event_details["failedSet"][0]["errorName"],
+                "error": event_details["failedSet"][0]["errorMessage"],
+            },
+        )
+        state_writer.drop()
+        return None
+    return (
+        event_arn,
+        str_update,
+        status_code,
+        event_details,
+        affected_org_accounts,
+        affected_org_entities,
+    )
+
+
+# lastUpdatedTime of a listed event in the "%s" format stored in dynamoDB
+def get_event_update_time(event):
+    str_ddb_format_sec = "%s"
+    try:
+        str_update = datetime.fromisoformat(event["lastUpdatedTime"])
+    except ValueError:
+        # only needed for times that didn't come from str(datetime)
+        from dateutil import parser
+
+        str_update = parser.parse(event["lastUpdatedTime"])
+    return str_update.strftime(str_ddb_format_sec)
+
+
+# the events of a describe_events page that have changed since they were stored, an event
+# whose listed lastUpdatedTime and statusCode match its stored state can't lead to an alert
+# so it is dropped before any accounts, entities or details are fetched for it. States seen
+# by this container are checked first, the rest are read from dynamoDB
+def get_updated_events(events):
+    listed_states = {
+        event["arn"]: (get_event_update_time(event), event["statusCode"])
+        for event in events
+    }
+    unknown_arns = [
+        arn for arn, state in listed_states.items() if known_event_states.get(arn) != state
+    ]
+    event_states = get_event_states(unknown_arns)
+    preloaded_event_items.clear()
+    if event_states is not None:
+        preloaded_event_items.update(dict.fromkeys(unknown_arns))
+        preloaded_event_items.update(event_states)
+    for arn, event_state in (event_states or {}).items():
+        remember_event_state(
+            arn, event_state.get("lastUpdatedTime"), event_state.get("statusCode")
+        )
+
+    updated_events = []
+    for event in events:
+        if known_event_states.get(event["arn"]) == listed_states[event["arn"]]:
+            logger.info(
+                "No new updates found", extra={"event_arn": event["arn"], "sample": True}
+            )
+            continue
+        updated_events.append(event)
+    return updated_events
+
+
+# arn -> stored item (None when there is no record) for the events of the page being
+# processed, used by the batch write mode in place of a conditional put
+preloaded_event_items = {}
+
+# arn -> (lastUpdatedTime, statusCode) last stored or seen in dynamoDB, kept across warm
+# invocations. Entries only ever short-circuit a listing that matches them exactly
+known_event_states = {}
+known_event_states_lock = threading.Lock()
+KNOWN_EVENT_STATES_LIMIT = 10000
+
+
+def remember_event_state(event_arn, str_update, status_code):
+    with known_event_states_lock:
+        if len(known_event_states) >= KNOWN_EVENT_STATES_LIMIT:
+            known_event_states.clear()
+        known_event_states[event_arn] = (str_update, status_code)
+
+
+# stored state of the given events. The batch write mode needs whole items, otherwise
+# only the fields compared with the listing are read. Returns None when the state
+# couldn't be read
+@metrics.timed("StateRead")
+def get_event_states(event_arns):
+    fields = None
+    if os.environ.get("DDB_WRITE_MODE", "conditional") != "batch":
+        fields = ("arn", "lastUpdatedTime", "statusCode")
+    try:
+        return state_store.get_items(event_arns, fields)
+    except ClientError as e:
+        logger.warning(
+            "Unable to preload event states", extra={"error": e.response["Error"]["Message"]}
+        )
+        return None
+
+
+# start of the lastUpdatedTime search window, narrowed to the last successful poll
+# (minus an overlap margin) except when a periodic full re-scan is due
+@metrics.timed("StateRead")
+def get_poll_window(poll_started, delta_hours):
+    full_window = poll_started - timedelta(hours=delta_hours)
+    if os.environ.get("INCREMENTAL_POLLING", "True") != "True":
+        return full_window, True
+
+    overlap = timedelta(minutes=int(os.environ.get("POLL_OVERLAP_MINUTES", "5")))
+    full_scan_interval = timedelta(
+        minutes=int(os.environ.get("FULL_SCAN_INTERVAL_MINUTES", "60"))
+    )
+    try:
+        watermark = state_store.get_item(POLL_WATERMARK_ARN)
+    except ClientError as e:
+        logger.warning(
+            "Unable to read the poll watermark", extra={"error": e.response["Error"]["Message"]}
+        )
+        return full_window, True
+
+    if watermark is None:
+        logger.info("No poll watermark found, running a full scan")
+        return full_window, True
+    last_poll = datetime.fromtimestamp(int(watermark["lastPoll"]))
+    last_full_scan = datetime.fromtimestamp(int(watermark["lastFullScan"]))
+    if poll_started - last_full_scan >= full_scan_interval:
+        logger.info("Periodic full scan is due, last full scan at %s", last_full_scan)
+        return full_window, True
+    return max(full_window, last_poll - overlap), False
+
+
+# record the start of a successful poll so the next run only asks for newer updates
+@metrics.timed("StateWrite")
+def save_poll_watermark(poll_started, full_scan):
+    if os.environ.get("INCREMENTAL_POLLING", "True") != "True":
+        return
+    sec_poll_started = int(datetime.strftime(poll_started, "%s"))
+    attributes = {"lastPoll": sec_poll_started}
+    if full_scan:
+        attributes["lastFullScan"] = sec_poll_started
+    try:
+        state_store.set_attributes(POLL_WATERMARK_ARN, attributes)
+    except ClientError as e:
+        logger.warning(
+            "Unable to save the poll watermark", extra={"error": e.response["Error"]["Message"]}
+        )
+
+
+def get_aha_ddb_table():
+    dynamodb = aws_api.resource("dynamodb")
+    return dynamodb.Table(os.environ["DYNAMODB_TABLE"])
+
+
+# event state, the poll watermark and the account directory snapshot are all kept
+# through a state store. DynamoDBStateStore is the deployed one, SQLiteStateStore has the
+# same semantics (conditional writes, ttl expiry) in a local file or in memory so the
+# poller can run offline against replayed Health data. Errors of the dynamoDB store are
+# raised as ClientError for the callers to handle
+class DynamoDBStateStore:
+    def get_item(self, arn):
+        return get_aha_ddb_table().get_item(Key={"arn": arn}).get("Item")
+
+    def put_item(self, item):
+        get_aha_ddb_table().put_item(Item=item)
+
+    def set_attributes(self, arn, attributes):
+        get_aha_ddb_table().update_item(
+            Key={"arn": arn},
+            UpdateExpression="SET "
+            + ", ".join(f"{name} = :{name}" for name in attributes),
+            ExpressionAttributeValues={f":{name}": value for name, value in attributes.items()},
+        )
+
+    # items of the given arns read with BatchGetItem in groups of 100 keys, limited to
+    # fields when given. Returns None when keys are still unprocessed after
+    # DDB_READ_MAX_ATTEMPTS calls
+    def get_items(self, arns, fields=None):
+        dynamodb = aws_api.resource("dynamodb")
+        ddb_table = os.environ["DYNAMODB_TABLE"]
+        max_attempts = int(os.environ.get("DDB_READ_MAX_ATTEMPTS", "5"))
+        items = {}
+        arns = list(dict.fromkeys(arns))
+        for i in range(0, len(arns), DDB_BATCH_GET_LIMIT):
+            request_items = {
+                ddb_table: {"Keys": [{"arn": arn} for arn in arns[i : i + DDB_BATCH_GET_LIMIT]]}
+            }
+            if fields:
+                request_items[ddb_table]["ProjectionExpression"] = ", ".join(fields)
+            for attempt in range(1, max_attempts + 1):
+                response = dynamodb.batch_get_item(RequestItems=request_items)
+                for item in response["Responses"].get(ddb_table, []):
+                    items[item["arn"]] = item
+                request_items = response.get("UnprocessedKeys")
+                if not request_items:
+                    break
+                if attempt < max_attempts:
+                    time.sleep(random.uniform(0, min(2, 0.05 * 2**attempt)))
+            else:
+                logger.warning(
+                    "%d event state keys still unprocessed after %d attempts",
+                    len(request_items[ddb_table]["Keys"]),
+                    max_attempts,
                 )
-                event_details = json.loads(event_details)
-                print("Event Details: ", event_details)
-                if event_details["successfulSet"] == []:
-                    print(
-                        "An error occured with account:",
-                        event_details["failedSet"][0]["awsAccountId"],
-                        "due to:",
-                        event_details["failedSet"][0]["errorName"],
-                        ":",
-                        event_details["failedSet"][0]["errorMessage"],
-                    )
-                    continue
-                else:
-                    # write to dynamoDB for persistence
-                    if update_org_ddb_flag:
-                        update_org_ddb(
-                            event_arn,
-                            str_update,
-                            status_code,
-                            event_details,
-                            affected_org_accounts,
-                            affected_org_entities,
-                        )
-        else:
-            print("No events found in time frame, checking again in 1 minute.")
+                return None
+        return items
+
+    # one BatchWriteItem call of up to 25 items, returns the arns left unprocessed
+    def put_items(self, items):
+        ddb_table = os.environ["DYNAMODB_TABLE"]
+        response = aws_api.resource("dynamodb").batch_write_item(
+            RequestItems={ddb_table: [{"PutRequest": {"Item": item}} for item in items]}
+        )
+        return {
+            request["PutRequest"]["Item"]["arn"]
+            for request in response.get("UnprocessedItems", {}).get(ddb_table, [])
+        }
+
+    # put the item unless the stored state doesn't warrant an alert (see
+    # is_event_state_changed), returns whether it was written. A condition can't compare
+    # a stored account list regardless of its order, so records written before the
+    # account fingerprint was stored only count as changed when their number of
+    # accounts differs, until they are rewritten or expire
+    def put_event_state_if_changed(self, item):
+        try:
+            get_aha_ddb_table().put_item(
+                Item=item,
+                ConditionExpression=(
+                    "attribute_not_exists(arn) OR (lastUpdatedTime <> :update AND ("
+                    "statusCode <> :status"
+                    " OR (attribute_exists(affectedAccountsHash)"
+                    " AND affectedAccountsHash <> :accounts)"
+                    " OR (attribute_not_exists(affectedAccountsHash)"
+                    " AND attribute_exists(affectedAccountIDs)"
+                    " AND size(affectedAccountIDs) <> :count)"
+                    " OR (attribute_exists(descriptionHash) AND descriptionHash <> :hash)"
+                    " OR (attribute_not_exists(descriptionHash) AND latestDescription <> :desc)))"
+                ),
+                ExpressionAttributeValues={
+                    ":update": item["lastUpdatedTime"],
+                    ":status": item["statusCode"],
+                    ":accounts": item["affectedAccountsHash"],
+                    ":count": item["affectedAccountCount"],
+                    ":hash": item["descriptionHash"],
+                    ":desc": item["latestDescription"],
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+    # set the lastUpdatedTime of a stored event that still has the given status, returns
+    # whether it was updated
+    def touch_event_state(self, arn, str_update, status_code):
+        try:
+            get_aha_ddb_table().update_item(
+                Key={"arn": arn},
+                UpdateExpression="SET lastUpdatedTime = :update",
+                ConditionExpression="attribute_exists(arn) AND statusCode = :status",
+                ExpressionAttributeValues={":update": str_update, ":status": status_code},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+
+# items are pickled whole into a single table keyed by arn, rows past their ttl are
+# treated as missing and purged on write like dynamoDB's TTL would eventually do
+class SQLiteStateStore:
+    def __init__(self, path):
+        # only imported when the local backend is selected
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS aha_state (arn TEXT PRIMARY KEY, ttl INTEGER, item BLOB)"
+        )
+
+    def read(self, arn):
+        row = self.connection.execute(
+            "SELECT item FROM aha_state WHERE arn = ? AND (ttl IS NULL OR ttl > ?)",
+            (arn, int(time.time())),
+        ).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def write(self, item):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO aha_state (arn, ttl, item) VALUES (?, ?, ?)",
+            (item["arn"], item.get("ttl"), pickle.dumps(item)),
+        )
+
+    def get_item(self, arn):
+        with self.lock:
+            return self.read(arn)
+
+    def put_item(self, item):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM aha_state WHERE ttl <= ?", (int(time.time()),)
+            )
+            self.write(item)
+
+    def set_attributes(self, arn, attributes):
+        with self.lock, self.connection:
+            self.write(dict(self.read(arn) or {"arn": arn}, **attributes))
+
+    def get_items(self, arns, fields=None):
+        with self.lock:
+            items = {arn: self.read(arn) for arn in dict.fromkeys(arns)}
+        return {
+            arn: {name: value for name, value in item.items() if not fields or name in fields}
+            for arn, item in items.items()
+            if item is not None
+        }
+
+    def put_items(self, items):
+        for item in items:
+            self.put_item(item)
+        return set()
+
+    def put_event_state_if_changed(self, item):
+        with self.lock, self.connection:
+            if not is_event_state_changed(item, self.read(item["arn"])):
+                return False
+            self.write(item)
+        return True
+
+    def touch_event_state(self, arn, str_update, status_code):
+        with self.lock, self.connection:
+            stored_item = self.read(arn)
+            if stored_item is None or stored_item.get("statusCode") != status_code:
+                return False
+            self.write(dict(stored_item, lastUpdatedTime=str_update))
+        return True
+
+
+# STATE_BACKEND=sqlite keeps the state in STATE_SQLITE_PATH, in memory by default
+def get_state_store():
+    if os.environ.get("STATE_BACKEND", "dynamodb") == "sqlite":
+        return SQLiteStateStore(os.environ.get("STATE_SQLITE_PATH", ":memory:"))
+    return DynamoDBStateStore()
+
+
+state_store = get_state_store()
 
 
 def myconverter(json_object):
@@ -938,6 +2227,24 @@ def myconverter(json_object):
         return json_object.__str__()
 
 
+# convert the datetime values of a Health response to strings in place, giving the same
+# result as a json.dumps(default=myconverter)/json.loads round-trip without copying it
+def normalize_datetimes(response):
+    if isinstance(response, dict):
+        fields = response.items()
+    elif isinstance(response, list):
+        fields = enumerate(response)
+    else:
+        return response
+    for key, value in fields:
+        if isinstance(value, datetime):
+            response[key] = myconverter(value)
+        elif isinstance(value, (dict, list)):
+            normalize_datetimes(value)
+    return response
+
+
+@metrics.timed("EventDetails")
 def describe_event_details(health_client, event_arn):
     response = health_client.describe_event_details(
         eventArns=[event_arn],
@@ -945,6 +2252,7 @@ def describe_event_details(health_client, event_arn):
     return response
 
 
+@metrics.timed("EventDetails")
 def describe_org_event_details(health_client, event_arn, affected_org_accounts):
     if len(affected_org_accounts) >= 1:
         affected_account_ids = affected_org_accounts[0]
@@ -959,105 +2267,332 @@ def describe_org_event_details(health_client, event_arn, affected_org_accounts):
     return response
 
 
+# PutEvents accepts up to 10 entries and 256 KB per call
+EVENTBRIDGE_MAX_ENTRIES = 10
+EVENTBRIDGE_MAX_BYTES = 256 * 1024
+
+
+# size of a PutEvents entry as EventBridge counts it against the 256 KB limit
+def eventbridge_entry_size(entry):
+    size = 14 if "Time" in entry else 0
+    for field in ("Source", "DetailType", "Detail"):
+        size += len(entry.get(field, "").encode("utf-8"))
+    for resource in entry.get("Resources", []):
+        size += len(resource.encode("utf-8"))
+    return size
+
+
 def eventbridge_generate_entries(message, resources, event_bus):
-    return [
-        {
+    entry = {
+        "Source": "aha",
+        "DetailType": "AHA Event",
+        "Resources": resources,
+        "Detail": json.dumps(message),
+        "EventBusName": event_bus,
+    }
+    if eventbridge_entry_size(entry) <= EVENTBRIDGE_MAX_BYTES:
+        return [entry]
+    return split_eventbridge_entries(message, event_bus)
+
+
+# size of an entry for message without any of its affectedEntities
+def eventbridge_base_size(message):
+    base_message = dict(
+        message,
+        affectedEntities=[],
+        affectedEntitiesChunk={"number": 999999, "total": 999999},
+    )
+    return eventbridge_entry_size(
+        {"Source": "aha", "DetailType": "AHA Event", "Detail": json.dumps(base_message)}
+    )
+
+
+# cut latestDescription short until the entry without entities fits in max_size bytes,
+# the whole description can be read from the Health API by the eventArn
+def truncate_eventbridge_description(message, max_size):
+    description = message["eventDescription"]["latestDescription"]
+    # escaped characters take more than one byte in the JSON detail
+    encoded_size = max(1, len(json.dumps(description)) - 2)
+    keep = len(description)
+    while True:
+        truncated = dict(
+            message,
+            eventDescription=dict(
+                message["eventDescription"],
+                latestDescription=description[:keep]
+                + " [truncated, see the event in AWS Health]",
+                latestDescriptionTruncated=True,
+            ),
+        )
+        excess = eventbridge_base_size(truncated) - max_size
+        if excess <= 0 or keep == 0:
+            break
+        keep = max(0, keep - max(1, excess * len(description) // encoded_size))
+    logger.warning(
+        "EventBridge entry for %s is over %d bytes, truncating its description",
+        message["eventArn"],
+        EVENTBRIDGE_MAX_BYTES,
+        extra={"description_length": len(description), "kept": keep},
+    )
+    return truncated
+
+
+# events affecting thousands of resources go over the EventBridge size limit, send them as
+# numbered chunks sharing the eventArn, each with its own slice of affectedEntities. A
+# description that takes more than half the limit is truncated to leave room for them
+def split_eventbridge_entries(message, event_bus):
+    entities = message["affectedEntities"]
+    base_size = eventbridge_base_size(message)
+    if base_size > EVENTBRIDGE_MAX_BYTES // 2:
+        message = truncate_eventbridge_description(message, EVENTBRIDGE_MAX_BYTES // 2)
+        base_size = eventbridge_base_size(message)
+    budget = EVENTBRIDGE_MAX_BYTES - base_size
+
+    chunks = [[]]
+    chunk_size = 0
+    for entity in entities:
+        # the entity in the detail, its separator and its entityValue in Resources
+        entity_size = len(json.dumps(entity).encode("utf-8")) + 2
+        entity_size += len(entity["entityValue"].encode("utf-8"))
+        if chunks[-1] and chunk_size + entity_size > budget:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(entity)
+        chunk_size += entity_size
+
+    logger.info(
+        "EventBridge entry for %s is over %d bytes, splitting %d entities into %d chunks",
+        message["eventArn"],
+        EVENTBRIDGE_MAX_BYTES,
+        len(entities),
+        len(chunks),
+    )
+    entries = []
+    for number, chunk in enumerate(chunks, start=1):
+        chunk_message = dict(
+            message,
+            affectedEntities=chunk,
+            affectedEntitiesChunk={"number": number, "total": len(chunks)},
+        )
+        entry = {
             "Source": "aha",
             "DetailType": "AHA Event",
-            "Resources": resources,
-            "Detail": json.dumps(message),
+            "Resources": get_resources_from_entities(chunk),
+            "Detail": json.dumps(chunk_message),
             "EventBusName": event_bus,
-        },
-    ]
+        }
+        # e.g. a single entity over the budget, EventBridge will reject the entry
+        if eventbridge_entry_size(entry) > EVENTBRIDGE_MAX_BYTES:
+            logger.error(
+                "EventBridge entry for %s is still over %d bytes",
+                message["eventArn"],
+                EVENTBRIDGE_MAX_BYTES,
+                extra={"chunk": number, "size": eventbridge_entry_size(entry)},
+            )
+        entries.append(entry)
+    return entries
 
 
 def send_to_eventbridge(message, event_type, resources, event_bus):
-    print(
-        "Sending response to Eventbridge - event_type, event_bus", event_type, event_bus
+    logger.info(
+        "Sending response to Eventbridge",
+        extra={"event_type": event_type, "event_bus": event_bus},
     )
-    client = aws_api.client("events")
-
     entries = eventbridge_generate_entries(message, resources, event_bus)
 
-    print("Sending entries: ", entries)
+    logger.debug("Queueing entries", extra={"entries": entries})
+    eventbridge_sink.add(entries)
+    return True
+
+
+# collects EventBridge entries across the whole poll and sends them with as few
+# PutEvents calls as the entry and size limits allow, retrying only failed entries.
+# Entries stay buffered until they are sent or dropped after EVENTBRIDGE_MAX_ATTEMPTS,
+# the sent and dropped counts are logged and recorded as metrics when the sink is flushed
+class EventBridgeSink:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []
+        self.size = 0
+        self.sent = 0
+        self.dropped = 0
+        self.max_attempts = int(os.environ.get("EVENTBRIDGE_MAX_ATTEMPTS", "3"))
+
+    def add(self, entries):
+        with self.lock:
+            for entry in entries:
+                entry_size = eventbridge_entry_size(entry)
+                if self.entries and (
+                    len(self.entries) == EVENTBRIDGE_MAX_ENTRIES
+                    or self.size + entry_size > EVENTBRIDGE_MAX_BYTES
+                ):
+                    self.put_events()
+                self.entries.append(entry)
+                self.size += entry_size
+
+    # called from the finally block of main, so it never raises
+    def flush(self):
+        with self.lock:
+            try:
+                if self.entries:
+                    self.put_events()
+            except Exception as e:
+                logger.exception(
+                    "Unable to send EventBridge entries",
+                    extra={"entries": len(self.entries)},
+                )
+                error = {"ErrorCode": type(e).__name__, "ErrorMessage": str(e)}
+                self.drop(self.entries, [error] * len(self.entries))
+            metrics.count("EventBridge.Sent", self.sent)
+            metrics.count("EventBridge.Dropped", self.dropped)
+            if self.sent or self.dropped:
+                log = logger.error if self.dropped else logger.info
+                log(
+                    "EventBridge delivery",
+                    extra={"sent": self.sent, "dropped": self.dropped},
+                )
+            self.sent = self.dropped = 0
+
+    # the entries left to send are kept in the buffer after every attempt, so an
+    # unexpected error leaves them to the next call instead of losing them
+    @metrics.timed("Alert.EventBridge")
+    def put_events(self):
+        pending = self.entries
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = aws_api.client("events").put_events(Entries=pending)
+            except ClientError as e:
+                logger.warning(
+                    "Got an error while sending entries to EventBridge",
+                    extra={"error": e.response["Error"]},
+                )
+                failed = [{"ErrorCode": e.response["Error"]["Code"]}] * len(pending)
+            except BotoCoreError as e:
+                logger.warning(
+                    "Got an error while sending entries to EventBridge",
+                    extra={"error": repr(e)},
+                )
+                failed = [{"ErrorCode": type(e).__name__, "ErrorMessage": str(e)}] * len(
+                    pending
+                )
+            else:
+                logger.debug("Response from eventbridge", extra={"response": response})
+                failed = response["Entries"]
+            retry = [
+                (entry, result)
+                for entry, result in zip(pending, failed)
+                if "ErrorCode" in result
+            ]
+            self.sent += len(pending) - len(retry)
+            pending = [entry for entry, _ in retry]
+            self.entries = pending
+            self.size = sum(eventbridge_entry_size(entry) for entry in pending)
+            if not pending:
+                return
+            if attempt < self.max_attempts:
+                logger.warning("Retrying %d failed EventBridge entries", len(pending))
+                time.sleep(random.uniform(0, 0.2 * 2**attempt))
+        self.drop(pending, [result for _, result in retry])
+
+    def drop(self, entries, results):
+        for result in results:
+            logger.error(
+                "Dropping EventBridge entry",
+                extra={
+                    "error_code": result.get("ErrorCode"),
+                    "error": result.get("ErrorMessage"),
+                },
+            )
+        self.dropped += len(entries)
+        self.entries, self.size = [], 0
+
 
-    response = client.put_events(Entries=entries)
-    print("Response from eventbridge is:", response)
+eventbridge_sink = EventBridgeSink()
+
+
+# account exclusion list, kept across warm invocations and only downloaded
+# again when the ETag of the .csv in S3 changes
+excluded_accounts_cache = {"key": None, "etag": None, "account_ids": frozenset()}
 
 
 def getAccountIDs():
-    account_ids = ""
+    account_ids = frozenset()
     key_file_name = os.environ["ACCOUNT_IDS"]
-    print("Key filename is - ", key_file_name)
+    logger.info("Key filename is %s", key_file_name)
     if os.path.splitext(os.path.basename(key_file_name))[1] == ".csv":
         s3 = aws_api.client("s3")
-        data = s3.get_object(Bucket=os.environ["S3_BUCKET"], Key=key_file_name)
-        account_ids = [account.decode("utf-8") for account in data["Body"].iter_lines()]
+        request = {"Bucket": os.environ["S3_BUCKET"], "Key": key_file_name}
+        if excluded_accounts_cache["key"] == key_file_name:
+            request["IfNoneMatch"] = excluded_accounts_cache["etag"]
+        try:
+            data = s3.get_object(**request)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("304", "NotModified"):
+                raise
+            logger.info("Account exclusion list is unchanged")
+            return excluded_accounts_cache["account_ids"]
+        account_ids = frozenset(
+            account.decode("utf-8").strip()
+            for account in data["Body"].iter_lines()
+            if account.strip()
+        )
+        excluded_accounts_cache.update(
+            key=key_file_name, etag=data["ETag"], account_ids=account_ids
+        )
     else:
-        print("Key filename is not a .csv file")
-    print(account_ids)
+        logger.warning("Key filename is not a .csv file")
+    logger.debug("Excluded accounts", extra={"account_ids": sorted(account_ids)})
     return account_ids
 
 
-def get_sts_token(service):
+# clients are made for the active Health region unless region_name is given
+def get_sts_token(service, region_name=None):
     assumeRoleArn = get_secrets()["ahaassumerole"]
     boto3_client = None
+    config = get_client_config(region_name or health_region.get())
 
     if "arn:aws:iam::" in assumeRoleArn:
-        ACCESS_KEY = []
-        SECRET_KEY = []
-        SESSION_TOKEN = []
-
-        sts_connection = aws_api.client("sts")
-
-        ct = datetime.now()
-        role_session_name = "cross_acct_aha_session"
-
-        acct_b = sts_connection.assume_role(
-            RoleArn=assumeRoleArn,
-            RoleSessionName=role_session_name,
-            DurationSeconds=900,
-        )
-
-        ACCESS_KEY = acct_b["Credentials"]["AccessKeyId"]
-        SECRET_KEY = acct_b["Credentials"]["SecretAccessKey"]
-        SESSION_TOKEN = acct_b["Credentials"]["SessionToken"]
-
         # create service client using the assumed role credentials, e.g. S3
-        boto3_client = aws_api.client(
-            service,
-            config=config,
-            aws_access_key_id=ACCESS_KEY,
-            aws_secret_access_key=SECRET_KEY,
-            aws_session_token=SESSION_TOKEN,
-        )
-        print("Running in member account deployment mode")
+        boto3_client = aws_api.role_client(assumeRoleArn, service, config=config)
+        logger.debug("Running in member account deployment mode")
     else:
         boto3_client = aws_api.client(service, config=config)
-        print("Running in management account deployment mode")
+        logger.debug("Running in management account deployment mode")
 
     return boto3_client
 
 
 def main(event, context):
-    aws_api.cache_clear()
-    print("THANK YOU FOR CHOOSING AWS HEALTH AWARE!")
-    health_client = get_sts_token("health")
+    metrics.reset()
+    secrets_cache.begin_invocation()
+    state_writer.dropped = 0
+    logger.info("THANK YOU FOR CHOOSING AWS HEALTH AWARE!")
+    health_client = HealthClientRouter()
     org_status = os.environ["ORG_STATUS"]
     # str_ddb_format_sec = '%s'
 
-    # check for AWS Organizations Status
-    if org_status == "No":
-        # TODO update text below to reflect current functionality
-        print(
-            "AWS Organizations is not enabled. Only Service Health Dashboard messages will be alerted."
-        )
-        describe_events(health_client)
-    else:
-        print(
-            "AWS Organizations is enabled. Personal Health Dashboard and Service Health Dashboard messages will be alerted."
-        )
-        describe_org_events(health_client)
+    try:
+        # check for AWS Organizations Status
+        if org_status == "No":
+            # TODO update text below to reflect current functionality
+            logger.info(
+                "AWS Organizations is not enabled. Only Service Health Dashboard messages will be alerted."
+            )
+            describe_events(health_client)
+        else:
+            logger.info(
+                "AWS Organizations is enabled. Personal Health Dashboard and Service Health Dashboard messages will be alerted."
+            )
+            describe_org_events(health_client)
+    finally:
+        # write the buffered event states, which may queue more EventBridge entries,
+        # then send the EventBridge entries still buffered before the invocation ends
+        state_writer.flush()
+        eventbridge_sink.flush()
+        metrics.emit()
+        suppressed = log_sampler.reset()
+        if suppressed:
+            logger.info("Suppressed repeated log messages", extra={"suppressed": suppressed})
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 import json
 from datetime import datetime
-import sys
 import logging
 
 logger = logging.getLogger()
@@ -113,7 +112,7 @@ def get_message_for_slack(event_details, event_type, affected_accounts, affected
                 "updates": get_last_aws_update(event_details)
             }
     
-    print("Message sent to Slack: ", message)
+    logger.debug("Message sent to Slack", extra={"slack_message": message})
     return message
 
 # COMMON compose the event detail field for org and non-org
@@ -130,10 +129,12 @@ def get_detail_for_eventbridge(event_details, affected_entities):
     message["eventDescription"] = event_details["successfulSet"][0]["eventDescription"]
     message["affectedEntities"] = affected_entities
 
-    # Log length of json message for debugging if eventbridge may reject the message as messages
-    # are limited in size to 256KB
-    json_message = json.dumps(message)
-    print("PHD/SHD Message generated for EventBridge with estimated size ", str(sys.getsizeof(json_message) / 1024), "KB: ", message)
+    # Log length of json message for debugging, messages over 256KB are split into chunks
+    # before they are sent to eventbridge
+    if logger.isEnabledFor(logging.DEBUG):
+        size_kb = len(json.dumps(message).encode("utf-8")) / 1024
+        logger.debug("PHD/SHD Message generated for EventBridge with size %.1f KB", size_kb,
+                     extra={"eventbridge_message": message})
 
     return message
 
@@ -239,8 +240,7 @@ def get_org_message_for_slack(event_details, event_type, affected_org_accounts,
                 "event_arn": event_details['successfulSet'][0]['event']['arn'],
                 "updates": get_last_aws_update(event_details)
             } 
-    json.dumps(message)
-    print("Message sent to Slack: ", message)
+    logger.debug("Message sent to Slack", extra={"slack_message": message})
     return message
 
 
@@ -286,7 +286,7 @@ def get_message_for_chime(event_details, event_type, affected_accounts, affected
           "**Updates:**" + "\n" + get_last_aws_update(event_details)
         )
     message = truncate_message_if_needed(message, 4096)
-    print("Message sent to Chime: ", message)    
+    logger.debug("Message sent to Chime", extra={"chime_message": message})
     return message
 
 
@@ -330,7 +330,7 @@ def get_org_message_for_chime(event_details, event_type, affected_org_accounts,
           "**Updates:**" + "\n" + get_last_aws_update(event_details)
         )
     message = truncate_message_if_needed(message, 4096)
-    print("Message sent to Chime: ", message)
+    logger.debug("Message sent to Chime", extra={"chime_message": message})
     return message  
 
 
@@ -402,7 +402,7 @@ def get_message_for_teams(event_details, event_type, affected_accounts, affected
                 }
             ]
         }
-    print("Message sent to Teams: ", message)
+    logger.debug("Message sent to Teams", extra={"teams_message": message})
     return message
 
 
@@ -471,8 +471,8 @@ def get_org_message_for_teams(event_details, event_type, affected_org_accounts,
                 }
             ]
         }
+    logger.debug("Message sent to Teams", extra={"teams_message": message})
     return message
-    print("Message sent to Teams: ", message)
 
 
 def get_message_for_email(event_details, event_type, affected_accounts, affected_entities):
@@ -530,7 +530,7 @@ def get_message_for_email(event_details, event_type, affected_accounts, affected
             </body>
         </html>
     """
-    print("Message sent to Email: ", BODY_HTML)
+    logger.debug("Message sent to Email", extra={"email_body": BODY_HTML})
     return BODY_HTML
 
 
@@ -585,7 +585,7 @@ def get_org_message_for_email(event_details, event_type, affected_org_accounts,
             </body>
         </html>
     """
-    print("Message sent to Email: ", BODY_HTML)
+    logger.debug("Message sent to Email", extra={"email_body": BODY_HTML})
     return BODY_HTML
 
 
@@ -646,6 +646,6 @@ def truncate_message_if_needed(message, max_length):
     """
     message_length = len(message)
     if message_length > max_length:
-        print(f"Message length of {message_length} is too long, truncating to {max_length}.")
+        logger.info("Message length of %d is too long, truncating to %d.", message_length, max_length)
         message = message[:(max_length - 3)] + "..."
     return message
@@ -520,6 +520,8 @@ data "aws_iam_policy_document" "AHA-LambdaPolicy-Document" {
           "dynamodb:PutItem",
           "dynamodb:DeleteItem",
           "dynamodb:GetItem",
+          "dynamodb:BatchGetItem",
+          "dynamodb:BatchWriteItem",
           "dynamodb:Scan",
           "dynamodb:Query",
           "dynamodb:UpdateItem",
@@ -532,6 +534,13 @@ data "aws_iam_policy_document" "AHA-LambdaPolicy-Document" {
           "arn:aws:dynamodb:${local.secondary_region}:${data.aws_caller_identity.current.account_id}:table/${var.dynamodbtable}-${random_string.resource_code.result}",
     ]
   }
+  statement {
+    effect   = "Allow"
+    actions   = [
+          "secretsmanager:BatchGetSecretValue",
+    ]
+    resources = [ "*" ]
+  }
   dynamic "statement" {
     for_each = var.SlackWebhookURL == "" ? [] : [1]
     content {